@@ -1,17 +1,72 @@
 import log
 import sys
+import os
 from pathlib import Path
 import subprocess
 import json
+import hashlib
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from copy import copy
+from functools import lru_cache
 
 
+CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache'), 'virtual-waggle')
+PLATFORM_CACHE_TTL = 24 * 3600
+BUILD_KEY_LABEL = 'waggle.plugin.build-key'
+
+
+class BuildError(Exception):
+    pass
+
+
+def get_docker_context():
+    # docker context show only reads the cli config, so it's much cheaper
+    # than asking the daemon. it also reflects DOCKER_CONTEXT and contexts
+    # selected with docker context use.
+    try:
+        return subprocess.check_output(['docker', 'context', 'show'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return os.environ.get('DOCKER_CONTEXT', '')
+
+
+def get_docker_host_key():
+    return '{}|{}'.format(os.environ.get('DOCKER_HOST', ''), get_docker_context())
+
+
+@lru_cache(maxsize=None)
 def get_platform():
-    return (
+    # docker version has to talk to the daemon, so we cache the result per
+    # docker host.
+    cache_path = CACHE_DIR / 'platform.json'
+    host_key = get_docker_host_key()
+
+    try:
+        cache = json.loads(cache_path.read_text())
+    except (OSError, ValueError):
+        cache = {}
+
+    entry = cache.get(host_key)
+    if entry is not None and time.time() - entry['time'] < PLATFORM_CACHE_TTL:
+        return entry['platform']
+
+    platform = (
         subprocess.check_output(['docker', 'version', '-f', '{{.Server.Os}}/{{.Server.Arch}}'])
         .decode()
         .strip()
     )
 
+    cache[host_key] = {'platform': platform, 'time': time.time()}
+
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        cache_path.write_text(json.dumps(cache))
+    except OSError:
+        pass
+
+    return platform
+
 
 def get_build_args_from_list(ls):
     results = []
@@ -30,35 +85,75 @@ def get_image_name_for_config(config):
 
 def load_sage_config_for_plugin(plugin_dir):
     if not plugin_dir.exists():
-        log.fatal(f'Plugin path "{plugin_dir}" does not exist.')
+        raise BuildError(f'Plugin path "{plugin_dir}" does not exist.')
     if not plugin_dir.is_dir():
-        log.fatal('Argument must point to base directory of a plugin.')
+        raise BuildError('Argument must point to base directory of a plugin.')
     try:
         return json.loads((plugin_dir / 'sage.json').read_text())
     except FileNotFoundError:
-        log.fatal('Plugin is missing sage.json metadata file.')
+        raise BuildError('Plugin is missing sage.json metadata file.')
+
+
+def raise_for_invalid_config(config):
+    for key, expected_type in [('id', int), ('version', str), ('name', str)]:
+        if not isinstance(config[key], expected_type):
+            raise ValueError(f'sage.json field "{key}" must be of type {expected_type.__name__}.')
+
+
+def get_source_for_platform(config, platform):
+    try:
+        return next(s for s in config['sources']
+                    if platform in s['architectures'])
+    except StopIteration:
+        raise BuildError(f'No source found for platform "{platform}".')
+
+
+def iter_plugin_files(plugin_dir):
+    for root, dirs, files in os.walk(plugin_dir):
+        dirs[:] = sorted(d for d in dirs if d != '.git')
+        for name in sorted(files):
+            yield Path(root, name)
+
+
+def get_build_key(plugin_dir, config, source, build_args, platform):
+    """Returns a key which changes whenever the plugin directory, sage.json,
+    the chosen source or the build args change."""
+    h = hashlib.sha256()
+
+    def update(*items):
+        for item in items:
+            data = item if isinstance(item, bytes) else str(item).encode()
+            h.update(len(data).to_bytes(8, 'big'))
+            h.update(data)
+
+    update(json.dumps(config, sort_keys=True), json.dumps(source, sort_keys=True), platform, *build_args)
+
+    for path in iter_plugin_files(plugin_dir):
+        update(path.relative_to(plugin_dir).as_posix(), os.stat(path).st_mode & 0o111)
+        file_hash = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                file_hash.update(chunk)
+        update(file_hash.digest())
+
+    return h.hexdigest()
 
 
 def get_build_command_for_config(args, config):
     # check config
-    assert isinstance(config['id'], int)
-    assert isinstance(config['version'], str)
-    assert isinstance(config['name'], str)
+    raise_for_invalid_config(config)
 
     image_name = get_image_name_for_config(config)
 
     # get source for platform
     platform = get_platform()
-
-    try:
-        source = next(s for s in config['sources']
-                      if platform in s['architectures'])
-    except StopIteration:
-        log.fatal(f'error: no source found for platform "{platform}"')
+    source = get_source_for_platform(config, platform)
 
     user_args = (get_build_args_from_list(args.build_arg) +
                  get_build_args_from_dict(source.get('build_args', {})))
 
+    build_key = get_build_key(args.plugin_dir, config, source, user_args, platform)
+
     return [
         'docker',
         'build',
@@ -67,25 +162,189 @@ def get_build_command_for_config(args, config):
         '--label', 'waggle.plugin.id={id}'.format(**config),
         '--label', 'waggle.plugin.version={version}'.format(**config),
         '--label', 'waggle.plugin.name={name}'.format(**config),
+        '--label', f'{BUILD_KEY_LABEL}={build_key}',
         '-t', image_name,
         str(args.plugin_dir),
     ]
 
 
-def run(args):
-    config = load_sage_config_for_plugin(args.plugin_dir)
+def get_build_key_from_command(cmd):
+    prefix = f'{BUILD_KEY_LABEL}='
+    return next(a[len(prefix):] for a in cmd if a.startswith(prefix))
+
+
+def get_image_build_key(image):
+    try:
+        return subprocess.check_output(['docker', 'inspect', '-f', f'{{{{ index .Config.Labels "{BUILD_KEY_LABEL}" }}}}', image],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except subprocess.CalledProcessError:
+        return None
+
+
+def find_cached_image(image_name, build_key):
+    """Returns True if image_name was tagged with an existing image built from
+    the same build key."""
+    # fast path for rebuilding the most recent image
+    if get_image_build_key(image_name) == build_key:
+        return True
+
+    output = subprocess.check_output(['docker', 'images', '-q', '--no-trunc',
+        '--filter', f'label={BUILD_KEY_LABEL}={build_key}']).decode().split()
+
+    if not output:
+        return False
+
+    subprocess.check_call(['docker', 'tag', output[0], image_name])
+    return True
+
+
+def build_plugin(args, plugin_dir, output=sys.stderr):
+    """Builds a single plugin and returns its image name and whether a cached
+    image was used."""
+    args = copy(args)
+    args.plugin_dir = plugin_dir
+
+    config = load_sage_config_for_plugin(plugin_dir)
     cmd = get_build_command_for_config(args, config)
+    image_name = get_image_name_for_config(config)
+
+    if not args.force and find_cached_image(image_name, get_build_key_from_command(cmd)):
+        print(f'Using cached image for {image_name}', file=output)
+        return image_name, True
+
     # print explicit build command used. helpful for debugging.
     cmdstr = ' '.join(cmd)
-    print(f'Running build command\n{cmdstr}', file=sys.stderr)
+    print(f'Running build command\n{cmdstr}', file=output, flush=True)
+
+    # exec docker build
+    subprocess.check_call(cmd, stdout=output, stderr=output)
+    return image_name, False
+
+
+def find_plugin_dirs(root):
+    for dirpath, dirs, files in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        if 'sage.json' in files:
+            dirs[:] = []
+            yield Path(dirpath)
+
+
+def get_base_image(plugin_dir):
+    """Returns the image from the first FROM line of the plugin's Dockerfile
+    or None if it can't be determined."""
+    try:
+        lines = (plugin_dir / 'Dockerfile').read_text().splitlines()
+    except OSError:
+        return None
+    for line in lines:
+        fields = line.split()
+        if len(fields) >= 2 and fields[0].upper() == 'FROM':
+            return next((f for f in fields[1:] if not f.startswith('--')), None)
+    return None
+
+
+def group_by_base_image(plugin_dirs):
+    groups = {}
+    for plugin_dir in plugin_dirs:
+        groups.setdefault(get_base_image(plugin_dir), []).append(plugin_dir)
+    return list(groups.values())
+
+
+def build_plugin_logged(args, plugin_dir):
+    start = time.monotonic()
+    log_file = tempfile.TemporaryFile('w+', errors='replace')
+    try:
+        image_name, cached = build_plugin(args, plugin_dir, output=log_file)
+        return plugin_dir, image_name, 'cached' if cached else 'built', time.monotonic() - start, None
+    except Exception as exc:
+        log_file.seek(0)
+        output = log_file.read()
+        # keep the error itself, as failures before docker build starts
+        # don't write any output.
+        return plugin_dir, None, 'failed', time.monotonic() - start, f'{output}error: {exc}'
+    finally:
+        log_file.close()
+
+
+def run_batch(args):
+    """Builds every plugin under a root directory. Plugins which share a base
+    image are grouped, so the first plugin in a group builds the shared layers
+    before the rest of the group are built using them."""
+    if args.jobs < 1:
+        log.fatal('Number of jobs must be at least 1.')
 
-    # exec docker build and print resulting image name.
-    subprocess.check_call(cmd, stdout=sys.stderr, stderr=sys.stderr)
-    print(get_image_name_for_config(config))
+    plugin_dirs = list(find_plugin_dirs(args.plugin_dir))
+
+    if not plugin_dirs:
+        log.fatal(f'No plugins found under "{args.plugin_dir}".')
+
+    groups = group_by_base_image(plugin_dirs)
+    results = []
+
+    print(f'Building {len(plugin_dirs)} plugins in {len(groups)} base image groups using {args.jobs} workers', file=sys.stderr)
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        pending = {}
+
+        for group in groups:
+            pending[executor.submit(build_plugin_logged, args, group[0])] = group[1:]
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                followers = pending.pop(future)
+                result = future.result()
+                results.append(result)
+                print(f'{result[2]} {result[0]} in {result[3]:.1f}s', file=sys.stderr, flush=True)
+                for plugin_dir in followers:
+                    pending[executor.submit(build_plugin_logged, args, plugin_dir)] = []
+
+    print_summary(results)
+
+    # print resulting image names
+    for plugin_dir, image_name, status, duration, output in results:
+        if image_name is not None:
+            print(image_name)
+
+    if any(status == 'failed' for _, _, status, _, _ in results):
+        sys.exit(1)
+
+
+def print_summary(results):
+    results = sorted(results, key=lambda r: str(r[0]))
+
+    for plugin_dir, image_name, status, duration, output in results:
+        if status == 'failed':
+            print(f'\n=== {plugin_dir} build output ===', file=sys.stderr)
+            print('\n'.join(output.splitlines()[-20:]), file=sys.stderr)
+
+    rows = [('plugin', 'image', 'status', 'time')]
+    rows += [(str(plugin_dir), image_name or '-', status, f'{duration:.1f}s') for plugin_dir, image_name, status, duration, _ in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(4)]
+
+    print(file=sys.stderr)
+    for row in rows:
+        print('  '.join(col.ljust(width) for col, width in zip(row, widths)), file=sys.stderr)
+
+
+def run(args):
+    if args.all:
+        run_batch(args)
+        return
+
+    try:
+        image_name, _ = build_plugin(args, args.plugin_dir)
+    except BuildError as exc:
+        log.fatal(str(exc))
+    # print resulting image name.
+    print(image_name)
 
 
 def register(subparsers):
     parser = subparsers.add_parser('build', help='build plugin for virtual waggle from a directory')
     parser.add_argument('--build-arg', action='append', default=[])
+    parser.add_argument('--force', action='store_true', help='build even if an image with the same content exists')
+    parser.add_argument('--all', action='store_true', help='build all plugins found under plugin_dir')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='number of plugins to build at once when using --all')
     parser.add_argument('plugin_dir', type=Path, help='base directory of plugin to build')
     parser.set_defaults(func=run)
@@ -0,0 +1,55 @@
+import log
+import subprocess
+import time
+from pathlib import Path
+
+
+CAPTURE_IMAGE = 'waggle/capture:vw'
+
+
+def wait_ignoring_interrupt(proc):
+    while True:
+        try:
+            return proc.wait()
+        except KeyboardInterrupt:
+            # docker passes the interrupt on to the container, which closes
+            # the recording before exiting.
+            pass
+
+
+def run(args):
+    output = Path(args.output or f'captures/{time.strftime("%Y%m%d-%H%M%S")}.vwrec')
+
+    if output.exists():
+        log.fatal(f'Recording {output} already exists.')
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+
+    capture_args = ['--exchange', args.exchange]
+    if args.duration:
+        capture_args += ['--duration', str(args.duration)]
+    if args.count:
+        capture_args += ['--count', str(args.count)]
+
+    proc = subprocess.Popen([
+        'docker', 'run', '--rm',
+        '--network', f'{args.project_name}_waggle',
+        '-v', f'{output.parent.absolute()}:/data',
+        CAPTURE_IMAGE,
+        'capture', f'/data/{output.name}',
+        *capture_args,
+    ])
+
+    if wait_ignoring_interrupt(proc) != 0:
+        log.fatal('Capture failed.')
+
+    log.notice(f'Recording written to {output}')
+
+
+def register(subparsers):
+    parser = subparsers.add_parser('capture', help='record messages from plugins for replay')
+    parser.add_argument('-o', '--output', help='recording to create (default: captures/<time>.vwrec)')
+    parser.add_argument('--exchange', default='messages', help='exchange to capture')
+    parser.add_argument('--duration', type=float, default=0, help='stop after this many seconds (default: until Ctrl-C)')
+    parser.add_argument('--count', type=int, default=0, help='stop after this many messages')
+    parser.set_defaults(func=run)
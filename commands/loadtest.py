@@ -0,0 +1,159 @@
+import log
+import rabbitmq
+import json
+import os
+import secrets
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+
+LOADTEST_IMAGE = 'waggle/loadtest:vw'
+LOADTEST_SCRIPT = Path('services/loadtest/loadtest.py')
+STANDIN_NAME = 'loadtest-beehive'
+SHOVEL_NAME = 'loadtest-to-beehive'
+
+# synthetic plugin IDs are chosen well above real plugin IDs.
+BASE_PLUGIN_ID = 60000
+
+
+def get_publisher_users(count):
+    # the plugin instance is a single byte, so we move to the next plugin ID
+    # every 256 publishers.
+    return [(f'plugin-{BASE_PLUGIN_ID + i // 256}-0.0.1-{i % 256}', secrets.token_hex(20)) for i in range(count)]
+
+
+def setup_standin(client, consume_from):
+    """Sets up a queue standing in for beehive. It's fed either by a shovel
+    from to-beehive, covering the whole staging path, or directly from the
+    messages exchange, covering only the broker."""
+    client.put(f'/exchanges/%2f/{STANDIN_NAME}', {'type': 'fanout', 'durable': False, 'auto_delete': False})
+    client.put(f'/queues/%2f/{STANDIN_NAME}', {'durable': False, 'auto_delete': False})
+    client.request('POST', f'/bindings/%2f/e/{STANDIN_NAME}/q/{STANDIN_NAME}', {'routing_key': ''})
+
+    if consume_from == 'messages':
+        client.request('POST', f'/bindings/%2f/e/messages/q/{STANDIN_NAME}', {'routing_key': ''})
+        return
+
+    queue = client.get('/queues/%2f/to-beehive')
+    if queue.get('consumers', 0) > 0:
+        log.warning('to-beehive already has consumers, such as the beehive shovels. Messages they consume will be reported as lost.')
+
+    client.put(f'/parameters/shovel/%2f/{SHOVEL_NAME}', {'value': {
+        'src-uri': 'amqp://',
+        'src-queue': 'to-beehive',
+        'dest-uri': 'amqp://',
+        'dest-exchange': STANDIN_NAME,
+        'ack-mode': 'on-confirm',
+        'prefetch-count': 1000,
+    }})
+
+
+def cleanup(client, users):
+    for path in [f'/parameters/shovel/%2f/{SHOVEL_NAME}', f'/queues/%2f/{STANDIN_NAME}', f'/exchanges/%2f/{STANDIN_NAME}']:
+        try:
+            client.delete(path)
+        except rabbitmq.ManagementError:
+            pass
+    for username, _ in users:
+        try:
+            client.delete_user(username)
+        except rabbitmq.ManagementError:
+            pass
+
+
+def get_loadtest_args(args):
+    return [
+        '--rates', args.rates,
+        '--step-duration', str(args.step_duration),
+        '--payload-size', str(args.payload_size),
+        '--consume-from', STANDIN_NAME,
+    ]
+
+
+def run_loadtest(args, users, output):
+    # credentials are passed through the environment, so they don't show up
+    # in the process list.
+    env = dict(os.environ, LOADTEST_USERS=json.dumps(users))
+
+    if args.in_process:
+        # requires the rabbitmq port on localhost, so run up with --debug.
+        return subprocess.call([sys.executable, str(LOADTEST_SCRIPT), '--url', 'amqp://127.0.0.1',
+            *get_loadtest_args(args), '-o', str(output)], env=env)
+
+    return subprocess.call([
+        'docker', 'run', '--rm',
+        '--network', f'{args.project_name}_waggle',
+        '-e', 'LOADTEST_USERS',
+        '-v', f'{output.parent.absolute()}:/results',
+        LOADTEST_IMAGE,
+        '--url', 'amqp://rabbitmq',
+        *get_loadtest_args(args),
+        '-o', f'/results/{output.name}',
+    ], env=env)
+
+
+def compare_results(previous_path, current_path):
+    previous = json.loads(Path(previous_path).read_text())
+    current = json.loads(Path(current_path).read_text())
+
+    def by_rate(results):
+        return {s['offered_rate']: s for s in results['steps']}
+
+    def ms(value):
+        return f'{value * 1000:.1f}' if value is not None else '-'
+
+    prev_steps = by_rate(previous)
+    print(f'\n{"offered/s":>10} {"recv/s before":>14} {"recv/s after":>13} {"p99 ms before":>14} {"p99 ms after":>13}')
+    for rate, step in by_rate(current).items():
+        prev = prev_steps.get(rate)
+        prev_throughput = f'{prev["throughput"]:.1f}' if prev else '-'
+        prev_p99 = ms(prev['latency']['p99']) if prev else '-'
+        print(f'{rate:>10.0f} {prev_throughput:>14} {step["throughput"]:>13.1f} {prev_p99:>14} {ms(step["latency"]["p99"]):>13}')
+
+
+def run(args):
+    if args.publishers < 1:
+        log.fatal('Number of publishers must be at least 1.')
+
+    output = Path(args.output or f'loadtest-results/{time.strftime("%Y%m%d-%H%M%S")}.json')
+    output.parent.mkdir(parents=True, exist_ok=True)
+
+    try:
+        client = rabbitmq.connect(args.project_name)
+    except rabbitmq.ManagementError as exc:
+        log.fatal(f'{exc} Please run ./virtual-waggle up --debug first.')
+
+    users = get_publisher_users(args.publishers)
+
+    with client:
+        try:
+            for username, password in users:
+                client.setup_user(username, password)
+            setup_standin(client, args.consume_from)
+
+            returncode = run_loadtest(args, users, output)
+        finally:
+            cleanup(client, users)
+
+    if returncode != 0 or not output.exists():
+        log.fatal('Load test failed.')
+
+    log.notice(f'Results written to {output}')
+
+    if args.compare:
+        compare_results(args.compare, output)
+
+
+def register(subparsers):
+    parser = subparsers.add_parser('loadtest', help='measure end-to-end message throughput and latency')
+    parser.add_argument('-n', '--publishers', type=int, default=4, help='number of synthetic plugin publishers')
+    parser.add_argument('--rates', default='100,200,500,1000,2000', help='total message rates in msg/s to step through')
+    parser.add_argument('--step-duration', type=float, default=10, help='seconds to run each rate')
+    parser.add_argument('--payload-size', type=int, default=100, help='payload size in bytes')
+    parser.add_argument('--consume-from', choices=['to-beehive', 'messages'], default='to-beehive', help='measure through staging to to-beehive or only to the messages exchange')
+    parser.add_argument('--in-process', action='store_true', help='run publishers in this process instead of a container. requires pika and pywaggle.')
+    parser.add_argument('-o', '--output', help='results file (default: loadtest-results/<time>.json)')
+    parser.add_argument('--compare', help='previous results file to compare against')
+    parser.set_defaults(func=run)
@@ -1,9 +1,143 @@
+import log
+import logstore
+import re
 import sys
+import threading
+import time
+from datetime import datetime
 from pathlib import Path
 import subprocess
 
 
+DEFAULT_STORE = '.virtual-waggle/logs'
+DISCOVER_INTERVAL = 5
+
+
+def parse_time(s):
+    """Parses either a duration before now, such as 30s, 10m, 2h or 1d, or an
+    ISO 8601 time."""
+    if s is None:
+        return None
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([smhd])', s)
+    if match:
+        value, unit = match.groups()
+        return time.time() - float(value) * {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[unit]
+    try:
+        return datetime.fromisoformat(s).timestamp()
+    except ValueError:
+        log.fatal(f'Invalid time "{s}". Use a duration like 10m or an ISO 8601 time.')
+
+
+def discover_containers(args):
+    """Returns a dict of container ID to log source name for all running
+    service and plugin containers in the project."""
+    output = subprocess.check_output(['docker', 'ps', '--format',
+        '{{.ID}}\t{{.Names}}\t{{.Label "com.docker.compose.project"}}\t{{.Label "com.docker.compose.service"}}'])
+
+    containers = {}
+    plugin_prefix = f'{args.project_name}_plugin-'
+
+    for line in output.decode().splitlines():
+        container_id, name, project, service = (line.split('\t') + ['', '', '', ''])[:4]
+        if project == args.project_name and service:
+            containers[container_id] = service
+        elif name.startswith(plugin_prefix):
+            containers[container_id] = name[len(args.project_name)+1:]
+
+    return containers
+
+
+def collect_container_logs(store, container_id, source, procs):
+    writer = store.writer(source)
+    since = store.last_timestamp(source)
+
+    cmd = ['docker', 'logs', '-f', '--timestamps']
+    if since is not None:
+        cmd += ['--since', f'{since:.6f}']
+
+    proc = subprocess.Popen(cmd + [container_id], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    procs[container_id] = proc
+
+    try:
+        for raw in proc.stdout:
+            timestamp, _, line = raw.decode(errors='replace').rstrip('\n').partition(' ')
+            try:
+                timestamp = logstore.parse_docker_timestamp(timestamp)
+            except ValueError:
+                continue
+            # --since is inclusive, so skip lines we've already stored
+            if since is not None and timestamp <= since:
+                continue
+            writer.write(timestamp, line)
+    finally:
+        writer.close()
+        proc.wait()
+        procs.pop(container_id, None)
+
+
+def run_collect(args):
+    store = logstore.LogStore(args.store)
+    procs = {}
+    threads = {}
+
+    log.notice(f'Collecting logs into {args.store}. Press Ctrl-C to stop.')
+
+    try:
+        while True:
+            # forget containers whose logs have ended, so threads doesn't
+            # grow as plugins come and go.
+            for container_id, thread in list(threads.items()):
+                if not thread.is_alive():
+                    thread.join()
+                    del threads[container_id]
+
+            for container_id, source in discover_containers(args).items():
+                if container_id in threads:
+                    continue
+                thread = threading.Thread(target=collect_container_logs, args=(store, container_id, source, procs))
+                thread.start()
+                threads[container_id] = thread
+            time.sleep(DISCOVER_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # stopping docker logs ends each thread, which then closes and indexes
+        # its open segment.
+        for proc in list(procs.values()):
+            proc.terminate()
+        for thread in threads.values():
+            thread.join()
+
+
+def run_query(args):
+    store = logstore.LogStore(args.store)
+
+    if not Path(args.store).exists():
+        log.fatal(f'No logs found in {args.store}. Run logs --collect first.')
+
+    try:
+        results = store.query(
+            sources=args.service or None,
+            since=parse_time(args.since),
+            until=parse_time(args.until),
+            pattern=args.grep)
+    except re.error as exc:
+        log.fatal(f'Invalid pattern: {exc}')
+
+    for timestamp, source, line in results:
+        when = datetime.fromtimestamp(timestamp).isoformat(timespec='milliseconds')
+        print(f'{when} {source} | {line}')
+
+
 def run(args):
+    if args.collect:
+        run_collect(args)
+        return
+
+    if args.service or args.since or args.until or args.grep:
+        run_query(args)
+        return
+
     extra_args = []
     if args.f:
         extra_args += ['-f']
@@ -16,4 +150,10 @@ def register(subparsers):
     parser = subparsers.add_parser('logs', help='show virtual waggle system logs')
     parser.add_argument('-f', action='store_true', help='follow logs')
     parser.add_argument('--tail', help='start at tail of logs')
+    parser.add_argument('--collect', action='store_true', help='collect service and plugin logs into the local log store')
+    parser.add_argument('--store', default=DEFAULT_STORE, help=f'local log store directory (default: {DEFAULT_STORE})')
+    parser.add_argument('--service', action='append', default=[], help='only show stored logs from this service or plugin container')
+    parser.add_argument('--since', help='only show stored logs after this time, such as 10m or 2020-06-01T12:00:00')
+    parser.add_argument('--until', help='only show stored logs before this time')
+    parser.add_argument('--grep', help='only show stored log lines matching this regular expression')
     parser.set_defaults(func=run)
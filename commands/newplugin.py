@@ -6,7 +6,6 @@ import re
 from shutil import copytree
 
 TEMPLATE_DIR = Path(sys.argv[0]).parent / 'templates'
-TEMPLATE_NAMES = [p.name for p in TEMPLATE_DIR.glob('*/')]
 
 sage_json_template = '''{{
     "id": 1000,
@@ -23,6 +22,10 @@ sage_json_template = '''{{
 '''
 
 
+def get_template_names():
+    return [p.name for p in TEMPLATE_DIR.glob('*/')]
+
+
 def plugin_name_valid(s):
     return re.match('[a-z0-9_-]+$', s) is not None
 
@@ -43,6 +46,6 @@ def run(args):
 
 def register(subparsers):
     parser = subparsers.add_parser('newplugin', help='generates a new plugin')
-    parser.add_argument('-t', '--template', default='simple', choices=TEMPLATE_NAMES, help='plugin template to use')
+    parser.add_argument('-t', '--template', default='simple', choices=get_template_names(), help='plugin template to use')
     parser.add_argument('name', help='name of plugin')
     parser.set_defaults(func=run)
@@ -1,9 +1,128 @@
 import os
+import sys
+import json
+import time
 import subprocess
+import rabbitmq
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 
+SERVICES = ['rabbitmq', 'registration', 'data-sharing-service', 'shovelctl', 'playback']
+
+
+def get_config_report(args):
+    return {
+        'registration_key_exists': Path('private/register.pem').exists(),
+        'node_id': os.environ.get('WAGGLE_NODE_ID'),
+        'sub_id': os.environ.get('WAGGLE_SUB_ID'),
+        'beehive_host': os.environ.get('WAGGLE_BEEHIVE_HOST'),
+    }
+
+
+def get_rate(stats, name):
+    return stats.get(f'{name}_details', {}).get('rate', 0.0)
+
+
+def get_rabbitmq_report(args):
+    with rabbitmq.connect(args.project_name) as client:
+        queues = client.get('/queues/%2f')
+        shovels = client.get('/shovels/%2f')
+
+    return {
+        'queues': {
+            q['name']: {
+                'messages': q.get('messages', 0),
+                'messages_ready': q.get('messages_ready', 0),
+                'messages_unacknowledged': q.get('messages_unacknowledged', 0),
+                'consumers': q.get('consumers', 0),
+                'publish_rate': get_rate(q.get('message_stats', {}), 'publish'),
+                'deliver_rate': get_rate(q.get('message_stats', {}), 'deliver_get'),
+                'ack_rate': get_rate(q.get('message_stats', {}), 'ack'),
+            } for q in queues
+        },
+        'shovels': {
+            s['name']: {
+                'state': s.get('state'),
+                'reason': s.get('reason'),
+                'timestamp': s.get('timestamp'),
+            } for s in shovels
+        },
+    }
+
+
+def get_rabbitmq_report_rabbitmqctl(args):
+    # fallback for hosts which can't reach the management api. this only
+    # provides queue depths.
+    output = subprocess.check_output(['docker-compose', '-p', args.project_name,
+        'exec', '-T', 'rabbitmq', 'rabbitmqctl', '-q', 'list_queues', 'name', 'messages', 'consumers'])
+
+    queues = {}
+
+    for line in output.decode().splitlines():
+        fields = line.split()
+        if len(fields) == 3 and fields[1].isdigit():
+            queues[fields[0]] = {
+                'messages': int(fields[1]),
+                'consumers': int(fields[2]),
+            }
+
+    return {'queues': queues}
+
+
+def get_rabbitmq_report_any(args):
+    try:
+        return get_rabbitmq_report(args)
+    except (OSError, rabbitmq.ManagementError):
+        return get_rabbitmq_report_rabbitmqctl(args)
+
+
+def get_service_logs(args, service):
+    containers = subprocess.check_output([
+        'docker', 'ps', '-a', '-q',
+        '--filter', f'label=com.docker.compose.project={args.project_name}',
+        '--filter', f'label=com.docker.compose.service={service}',
+    ]).decode().split()
+
+    if not containers:
+        return None
+
+    output = subprocess.run(['docker', 'logs', '--tail', str(args.tail), containers[0]],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True).stdout
+    return output.decode(errors='replace').splitlines()
+
+
+def call_with_error(func, *args):
+    try:
+        return {'ok': True, 'result': func(*args)}
+    except Exception as exc:
+        return {'ok': False, 'error': str(exc)}
+
+
+def run_json(args):
+    start = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=len(SERVICES) + 1) as executor:
+        rabbitmq_future = executor.submit(call_with_error, get_rabbitmq_report_any, args)
+        log_futures = {service: executor.submit(call_with_error, get_service_logs, args, service) for service in SERVICES}
+
+        report = {
+            'time': time.time(),
+            'config': get_config_report(args),
+            'rabbitmq': rabbitmq_future.result(),
+            'logs': {service: future.result() for service, future in log_futures.items()},
+        }
+
+    report['duration'] = time.monotonic() - start
+    json.dump(report, sys.stdout, separators=(',', ':'))
+    print()
+
+
 def run(args):
+    if args.json:
+        run_json(args)
+        return
+
     print('=== Config Info ===')
     print('Registration Key Exists:', 'Yes' if Path(
         'private/register.pem').exists() else 'No')
@@ -29,4 +148,6 @@ def run(args):
 
 def register(subparsers):
     parser = subparsers.add_parser('report', help='show virtual waggle system report for debugging')
+    parser.add_argument('--json', action='store_true', help='print report as json')
+    parser.add_argument('--tail', type=int, default=100, help='number of log lines per service in json report')
     parser.set_defaults(func=run)
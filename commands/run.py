@@ -1,10 +1,17 @@
 import log
+import rabbitmq
+import placement
 import argparse
+import os
 import sys
 from pathlib import Path
 import subprocess
 import secrets
 import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 
 def run_quiet(*args, **kwargs):
@@ -21,7 +28,7 @@ def get_docker_image_labels(image):
     return json.loads(output)
 
 
-def setup_rabbitmq_user(args, username, password):
+def setup_rabbitmq_user_rabbitmqctl(args, username, password):
     run_quiet([
         'docker-compose', '-p', args.project_name,
         'exec', 'rabbitmq',
@@ -52,72 +59,243 @@ def setup_rabbitmq_user(args, username, password):
     ])
 
 
-def has_plugin(plugin):
+def find_management_client(args):
+    """Returns a client for the management api or None if it isn't reachable
+    from this host."""
     try:
-        run_quiet(['docker', 'inspect', plugin], check=True)
-        return True
-    except subprocess.CalledProcessError:
-        return False
+        return rabbitmq.connect(args.project_name)
+    except (OSError, rabbitmq.ManagementError):
+        return None
+
+
+def setup_rabbitmq_user(args, management_client, username, password):
+    # the management api avoids starting compose and an erlang vm for each
+    # rabbitmqctl command, but isn't reachable from every host. the setup
+    # threads share the client connect returned, so they all use the address
+    # and port it found and take turns on its connection.
+    if management_client is not None:
+        try:
+            management_client.setup_user(username, password)
+            return
+        except (OSError, rabbitmq.ManagementError):
+            pass
+    setup_rabbitmq_user_rabbitmqctl(args, username, password)
+
+
+@contextmanager
+def timed(timings, phase):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        timings[phase] = time.monotonic() - start
+
+
+def format_timings(timings):
+    total = sum(timings.values())
+    phases = ', '.join(f'{phase} {duration:.2f}s' for phase, duration in timings.items())
+    return f'{total:.2f}s ({phases})'
 
 
 def run(args):
-    if not has_plugin(args.plugin):
+    if args.instances < 1:
+        log.fatal('Number of instances must be at least 1.')
+
+    timings = {}
+
+    with timed(timings, 'inspect'):
+        try:
+            labels = get_docker_image_labels(args.plugin)
+        except subprocess.CalledProcessError:
+            labels = None
+
+    if labels is None:
         print(
             f'Did not find plugin {args.plugin} locally. Pulling from remote...')
         try:
-            subprocess.check_call(['docker', 'pull', args.plugin])
+            with timed(timings, 'pull'):
+                subprocess.check_call(['docker', 'pull', args.plugin])
         except subprocess.CalledProcessError:
             log.fatal(f'Failed to pull plugin {args.plugin}.')
-
-    labels = get_docker_image_labels(args.plugin)
+        labels = get_docker_image_labels(args.plugin)
 
     config = json.loads(labels['waggle.plugin.config'])
+    # TODO add back in support for devices / volumes
+
+    try:
+        request = placement.get_resource_request(config)
+    except ValueError as exc:
+        log.fatal(str(exc))
+
+    instances = [get_instance(args, config, i) for i in range(args.instances)]
+
+    print(f'Setting up {args.plugin}')
+
+    # placement is checked first, so a plugin which doesn't fit fails before
+    # any containers are removed or users are set up.
+    placements = None
+
+    if not args.no_placement:
+        with timed(timings, 'placement'):
+            placements = place_instances(args, instances, request)
 
+    try:
+        with timed(timings, 'management api'):
+            management_client = find_management_client(args)
+
+        # remove any old containers and set up the rabbitmq users concurrently
+        try:
+            with timed(timings, 'setup'):
+                with ThreadPoolExecutor(max_workers=min(len(instances), 16)) as executor:
+                    list(executor.map(lambda instance: setup_instance(args, management_client, instance), instances))
+        finally:
+            if management_client is not None:
+                management_client.close()
+
+        print(f'Setup took {format_timings(timings)}')
+        print(f'Running {args.plugin}\n')
+
+        if len(instances) == 1:
+            status = subprocess.run(['docker', 'run', '-it'] + get_docker_run_args(args, config, instances[0], placements)).returncode
+        else:
+            status = run_multiplexed(args, config, instances, placements)
+    finally:
+        print(f'Cleaning up {args.plugin}')
+        run_quiet(['docker', 'rm', '-f'] + [instance['name'] for instance in instances])
+        if placements is not None:
+            placements.release([instance['name'] for instance in instances])
+
+    if status != 0:
+        sys.exit(status)
+
+
+def place_instances(args, instances, request):
+    """Assigns each instance a cpuset and limits from the project's free
+    capacity. Returns the placements they were made in or None if the docker
+    host couldn't be inspected."""
+    try:
+        placements = placement.Placements.for_project(args.project_name,
+            args.reserved_cpus, placement.parse_memory(args.reserved_memory))
+    except (subprocess.CalledProcessError, ValueError):
+        log.warning('Could not get docker host resources. Running without placement.')
+        return None
+
+    try:
+        allocations = placements.place([instance['name'] for instance in instances], request)
+    except placement.PlacementError as exc:
+        log.fatal(f'{exc} Stop other plugins, lower the resources in sage.json or use --no-placement.')
+
+    for instance, allocation in zip(instances, allocations):
+        instance['allocation'] = allocation
+        print(f'Placed instance {instance["instance"]}: {placement.describe(allocation)}')
+
+    return placements
+
+
+def get_instance(args, config, plugin_instance):
     plugin_name = config['name']
     plugin_id = int(config['id'])
     plugin_version = config['version']
-    plugin_name = config['name']
-    plugin_instance = 0
-    plugin_username = f'plugin-{plugin_id}-{plugin_version}-{plugin_instance}'
-    plugin_password = generate_random_password()
-    # TODO add back in support for devices / volumes
+    return {
+        'instance': plugin_instance,
+        'username': f'plugin-{plugin_id}-{plugin_version}-{plugin_instance}',
+        'password': generate_random_password(),
+        'name': f'{args.project_name}_plugin-{plugin_name}-{plugin_version}-{plugin_instance}',
+    }
 
-    print(f'Setting up {args.plugin}')
-    setup_rabbitmq_user(args, plugin_username, plugin_password)
 
-    network = f'{args.project_name}_waggle'
-    name = f'{args.project_name}_plugin-{plugin_name}-{plugin_version}-{plugin_instance}'
+def setup_instance(args, management_client, instance):
+    remove_old = subprocess.Popen(['docker', 'rm', '-f', instance['name']],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    setup_rabbitmq_user(args, management_client, instance['username'], instance['password'])
+    remove_old.wait()
 
-    run_quiet(['docker', 'rm', '-f', name])
 
+def get_docker_run_args(args, config, instance, placements=None):
+    plugin_name = config['name']
+    plugin_id = int(config['id'])
+    plugin_version = config['version']
+    network = f'{args.project_name}_waggle'
     data_config_path = Path('./data-config.json').absolute()
 
+    placement_args = []
+    if placements is not None:
+        placement_args = placements.get_docker_args(instance['allocation'])
+
+    return [
+        '--name', instance['name'],
+        '--network', network,
+        *placement_args,
+        '--env-file', 'waggle-node.env',
+        '--restart', 'on-failure',
+        '-e', f'WAGGLE_PLUGIN_NAME={plugin_name}:{plugin_version}',
+        '-e', f'WAGGLE_PLUGIN_ID={plugin_id}',
+        '-e', f'WAGGLE_PLUGIN_VERSION={plugin_version}',
+        '-e', f'WAGGLE_PLUGIN_INSTANCE={instance["instance"]}',
+        '-e', f'WAGGLE_PLUGIN_USERNAME={instance["username"]}',
+        '-e', f'WAGGLE_PLUGIN_PASSWORD={instance["password"]}',
+        '-v', f'{data_config_path}:/run/waggle/data-config.json',
+        args.plugin,
+        *args.plugin_args,
+    ]
+
+
+def run_multiplexed(args, config, instances, placements=None):
+    """Runs all instances at once and prints their output prefixed by the
+    instance number. Stops all instances when any of them exits with an error
+    or on interrupt. Returns the exit status of the first instance which
+    failed or 0."""
+    print_lock = threading.Lock()
+    width = len(str(len(instances) - 1))
+
+    def forward_output(instance, proc):
+        prefix = f'[{instance["instance"]:>{width}}] '
+        for line in proc.stdout:
+            with print_lock:
+                sys.stdout.write(prefix + line.decode(errors='replace'))
+                sys.stdout.flush()
+
+    procs = []
+    threads = []
+
     try:
-        print(f'Running {args.plugin}\n')
+        for instance in instances:
+            proc = subprocess.Popen(['docker', 'run'] + get_docker_run_args(args, config, instance, placements),
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            thread = threading.Thread(target=forward_output, args=(instance, proc), daemon=True)
+            thread.start()
+            procs.append(proc)
+            threads.append(thread)
 
-        subprocess.run([
-            'docker', 'run', '-it',
-            '--name', name,
-            '--network', network,
-            '--env-file', 'waggle-node.env',
-            '--restart', 'on-failure',
-            '-e', f'WAGGLE_PLUGIN_NAME={plugin_name}:{plugin_version}',
-            '-e', f'WAGGLE_PLUGIN_ID={plugin_id}',
-            '-e', f'WAGGLE_PLUGIN_VERSION={plugin_version}',
-            '-e', f'WAGGLE_PLUGIN_INSTANCE={plugin_instance}',
-            '-e', f'WAGGLE_PLUGIN_USERNAME={plugin_username}',
-            '-e', f'WAGGLE_PLUGIN_PASSWORD={plugin_password}',
-            '-v', f'{data_config_path}:/run/waggle/data-config.json',
-            args.plugin,
-            *args.plugin_args,
-        ])
+        running = list(zip(instances, procs))
+
+        while running:
+            time.sleep(0.1)
+            for instance, proc in list(running):
+                if proc.poll() is None:
+                    continue
+                running.remove((instance, proc))
+                if proc.returncode != 0:
+                    log.warning(f'Instance {instance["instance"]} exited with status {proc.returncode}. Stopping all instances.')
+                    return proc.returncode
+
+        return 0
     finally:
-        print(f'Cleaning up {args.plugin}')
-        run_quiet(['docker', 'rm', '-f', name])
+        # removing the containers causes the attached docker run processes
+        # to exit, so we just wait for them and their output to finish.
+        run_quiet(['docker', 'rm', '-f'] + [instance['name'] for instance in instances])
+        for proc in procs:
+            proc.wait()
+        for thread in threads:
+            thread.join()
 
 
 def register(subparsers):
     parser = subparsers.add_parser('run', help='runs a plugin inside virtual waggle environment')
+    parser.add_argument('-n', '--instances', type=int, default=1, help='number of plugin instances to run')
+    parser.add_argument('--reserved-cpus', type=int, default=int(os.environ.get('WAGGLE_RESERVED_CPUS', '1')), help='cores kept free of plugins for the core services')
+    parser.add_argument('--reserved-memory', default=os.environ.get('WAGGLE_RESERVED_MEMORY', '512M'), help='memory kept free of plugins for the core services')
+    parser.add_argument('--no-placement', action='store_true', help='run without assigning cpusets and resource limits')
     parser.add_argument('plugin', help='plugin to run')
     parser.add_argument('plugin_args', nargs=argparse.REMAINDER, help='arguments to pass to plugin')
     parser.set_defaults(func=run)
@@ -0,0 +1,21 @@
+import subprocess
+
+
+def run(args):
+    extra_args = []
+    if args.watch:
+        extra_args += ['--watch']
+    if args.json:
+        extra_args += ['--json']
+    if args.interval:
+        extra_args += ['--interval', args.interval]
+    subprocess.check_call(['docker-compose', '-p', args.project_name,
+                           'run', '--rm', '--no-deps', 'shovelctl', 'status'] + extra_args)
+
+
+def register(subparsers):
+    parser = subparsers.add_parser('status', help='show shovel and queue throughput')
+    parser.add_argument('-w', '--watch', action='store_true', help='keep showing status')
+    parser.add_argument('--json', action='store_true', help='write status as json lines')
+    parser.add_argument('--interval', help='polling interval in seconds')
+    parser.set_defaults(func=run)
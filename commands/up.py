@@ -1,10 +1,174 @@
 import log
+import rabbitmq
 import sys
+import json
+import time
+import http.client
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import subprocess
 
 
+DEFINITIONS_PATH = Path('services/rabbitmq-nc/configs/definitions.json')
+
+
+def is_service_running(args, service):
+    output = subprocess.check_output([
+        'docker', 'ps', '-q',
+        '--filter', f'label=com.docker.compose.project={args.project_name}',
+        '--filter', f'label=com.docker.compose.service={service}',
+        '--filter', 'status=running',
+    ])
+    return len(output.strip()) > 0
+
+
+def get_expected_queues():
+    try:
+        definitions = json.loads(DEFINITIONS_PATH.read_text())
+    except (OSError, ValueError):
+        return set()
+    return {q['name'] for q in definitions.get('queues', []) if q.get('vhost', '/') == '/'}
+
+
+class ManagementProbe:
+    """Base for probes which use the management api. The client is created
+    once the api is reachable and reused for later polls."""
+
+    def __init__(self, args):
+        self.args = args
+        self.client = None
+
+    def __call__(self):
+        if self.client is None:
+            self.client = rabbitmq.connect(self.args.project_name)
+        try:
+            return self.check(self.client)
+        except (OSError, rabbitmq.ManagementError):
+            self.client.close()
+            self.client = None
+            raise
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+
+
+class RabbitMQProbe(ManagementProbe):
+
+    def __init__(self, args):
+        super().__init__(args)
+        self.expected_queues = get_expected_queues()
+
+    def check(self, client):
+        queues = {q['name'] for q in client.get('/queues/%2f?columns=name')}
+        return self.expected_queues <= queues
+
+
+class ShovelProbe(ManagementProbe):
+
+    def check(self, client):
+        if not client.get('/parameters/shovel/%2f'):
+            return False
+        # shovels to beehive can only start once the node is registered
+        if not Path('private/register.pem').exists():
+            return True
+        shovels = client.get('/shovels/%2f')
+        return len(shovels) > 0 and all(s.get('state') == 'running' for s in shovels)
+
+
+class PlaybackProbe:
+
+    def __init__(self, args):
+        self.args = args
+
+    def __call__(self):
+        # playback is published on localhost when running with --debug. we
+        # only probe localhost then, so we don't mistake another project's
+        # playback server for ours.
+        published = rabbitmq.get_published_address(self.args.project_name, 'playback', 8090)
+        if published is not None and self.check(*published):
+            return True
+        return self.check(rabbitmq.get_service_address(self.args.project_name, 'playback'))
+
+    def check(self, host, port=8090):
+        if host is None:
+            return False
+        conn = http.client.HTTPConnection(host, port, timeout=1)
+        try:
+            conn.request('GET', '/')
+            conn.getresponse().read()
+            return True
+        except OSError:
+            return False
+        finally:
+            conn.close()
+
+    def close(self):
+        pass
+
+
+class ContainerProbe:
+
+    def __init__(self, args, service):
+        self.args = args
+        self.service = service
+
+    def __call__(self):
+        return is_service_running(self.args, self.service)
+
+    def close(self):
+        pass
+
+
+def get_probes(args):
+    return {
+        'rabbitmq': RabbitMQProbe(args),
+        'shovelctl': ShovelProbe(args),
+        'registration': ContainerProbe(args, 'registration'),
+        'data-sharing-service': ContainerProbe(args, 'data-sharing-service'),
+        'playback': PlaybackProbe(args),
+    }
+
+
+def wait_until_ready(probe, start, deadline, interval=0.25):
+    """Polls probe until it's ready and returns the time since start or None
+    if the deadline passed first."""
+    try:
+        while time.monotonic() < deadline:
+            try:
+                if probe():
+                    return time.monotonic() - start
+            except (OSError, ValueError, subprocess.CalledProcessError, rabbitmq.ManagementError):
+                pass
+            time.sleep(interval)
+        return None
+    finally:
+        probe.close()
+
+
+def wait_for_services(args, start):
+    probes = get_probes(args)
+    deadline = time.monotonic() + args.timeout
+
+    with ThreadPoolExecutor(max_workers=len(probes)) as executor:
+        futures = {name: executor.submit(wait_until_ready, probe, start, deadline) for name, probe in probes.items()}
+        results = {name: future.result() for name, future in futures.items()}
+
+    width = max(len(name) for name in results)
+    for name, duration in results.items():
+        status = f'ready after {duration:.1f}s' if duration is not None else 'not ready'
+        print(f'{name:<{width}}  {status}', file=sys.stderr)
+
+    not_ready = [name for name, duration in results.items() if duration is None]
+    if not_ready:
+        log.fatal(f'Timed out waiting for {", ".join(not_ready)}.')
+
+    log.notice(f'Virtual Waggle is ready after {time.monotonic() - start:.1f}s')
+
+
 def run(args):
+    start = time.monotonic()
+
     if not Path('private/register.pem').exists():
         log.warning('No registration key found. Running in local only mode.')
     
@@ -22,6 +186,10 @@ def run(args):
         extra_args += ['-f', 'docker-compose.ros.yml']
         log.notice('ROS plugins should use ROS_MASTER_URI=http://ros-master:11311')
 
+    # Enable store and forward spool for the beehive uplink.
+    if args.spool:
+        extra_args += ['-f', 'docker-compose.spool.yml']
+
     # Deploy docker compose files.
     subprocess.check_call([
         'docker-compose',
@@ -30,9 +198,15 @@ def run(args):
         *extra_args,
         'up', '-d', '--remove-orphans'])
 
+    if args.wait:
+        wait_for_services(args, start)
+
 
 def register(subparsers):
     parser = subparsers.add_parser('up', help='start virtual waggle environment')
     parser.add_argument('--debug', action='store_true', help='open local service ports for debugging')
     parser.add_argument('--ros', action='store_true', help='run local ros master')
+    parser.add_argument('--spool', action='store_true', help='spool messages for beehive to disk while the uplink is down')
+    parser.add_argument('--wait', action='store_true', help='wait until all services are ready')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds to wait for services when using --wait')
     parser.set_defaults(func=run)
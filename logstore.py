@@ -0,0 +1,208 @@
+"""
+Segmented, compressed log store with a time and source index.
+
+Each source (a service or plugin container) writes to its own sequence of
+gzip segments. Every line is stored as "<unix time>\t<line>". When a segment
+is closed, its source, time range and line count are appended to index.jsonl,
+so queries only open the segments which overlap the requested sources and
+time range. Segments which are still open, or weren't closed cleanly, aren't
+in the index yet and are always scanned.
+"""
+import calendar
+import gzip
+import heapq
+import json
+import re
+import threading
+import time
+import zlib
+from pathlib import Path
+
+
+SEGMENT_MAX_BYTES = 4 * 1024 * 1024
+SEGMENT_MAX_AGE = 3600
+FLUSH_INTERVAL = 1.0
+
+
+def sanitize_source(source):
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', source)
+
+
+def parse_docker_timestamp(s):
+    """Parses the UTC RFC3339Nano timestamps added by docker logs --timestamps."""
+    date, _, frac = s.rstrip('Z').partition('.')
+    seconds = calendar.timegm(time.strptime(date, '%Y-%m-%dT%H:%M:%S'))
+    return seconds + (float('0.' + frac) if frac else 0.0)
+
+
+class SegmentWriter:
+
+    def __init__(self, store, source):
+        self.store = store
+        self.source = sanitize_source(source)
+        self.file = None
+
+    def open(self, timestamp):
+        dir = self.store.segment_dir(self.source)
+        dir.mkdir(parents=True, exist_ok=True)
+        self.path = dir / f'{timestamp:.6f}.gz'
+        self.raw = open(self.path, 'ab')
+        self.file = gzip.GzipFile(fileobj=self.raw, mode='ab')
+        self.start = timestamp
+        self.end = timestamp
+        self.lines = 0
+        self.opened_at = time.monotonic()
+        self.flushed_at = self.opened_at
+
+    def write(self, timestamp, line):
+        if self.file is not None and (self.raw.tell() >= SEGMENT_MAX_BYTES or
+                                      time.monotonic() - self.opened_at >= SEGMENT_MAX_AGE):
+            self.close()
+
+        if self.file is None:
+            self.open(timestamp)
+
+        self.file.write(f'{timestamp:.6f}\t{line}\n'.encode())
+        self.end = max(self.end, timestamp)
+        self.lines += 1
+
+        # sync flush periodically, so queries can read open segments
+        now = time.monotonic()
+        if now - self.flushed_at >= FLUSH_INTERVAL:
+            self.file.flush(zlib.Z_SYNC_FLUSH)
+            self.raw.flush()
+            self.flushed_at = now
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.raw.close()
+        self.file = None
+        self.store.add_index_entry({
+            'source': self.source,
+            'path': str(self.path.relative_to(self.store.root)),
+            'start': self.start,
+            'end': self.end,
+            'lines': self.lines,
+        })
+
+
+class LogStore:
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.index_path = self.root / 'index.jsonl'
+        self.index_lock = threading.Lock()
+
+    def segment_dir(self, source):
+        return self.root / 'segments' / sanitize_source(source)
+
+    def add_index_entry(self, entry):
+        with self.index_lock:
+            self.root.mkdir(parents=True, exist_ok=True)
+            with open(self.index_path, 'a') as f:
+                f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+    def read_index(self):
+        try:
+            with open(self.index_path) as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        pass
+        except FileNotFoundError:
+            return
+
+    def writer(self, source):
+        return SegmentWriter(self, source)
+
+    def last_timestamp(self, source):
+        """Returns the time of the last stored line for source or None. Used
+        to resume collection without storing lines twice."""
+        source = sanitize_source(source)
+        last = max((entry['end'] for entry in self.read_index() if entry['source'] == source), default=None)
+        for path in self.unindexed_segments(source):
+            for timestamp, _ in read_segment(self.root / path):
+                if last is None or timestamp > last:
+                    last = timestamp
+        return last
+
+    def unindexed_segments(self, source=None):
+        indexed = {entry['path'] for entry in self.read_index()}
+        segments_dir = self.root / 'segments'
+        dirs = [self.segment_dir(source)] if source is not None else sorted(segments_dir.glob('*'))
+        for dir in dirs:
+            for path in sorted(dir.glob('*.gz')):
+                rel = str(path.relative_to(self.root))
+                if rel not in indexed:
+                    yield rel
+
+    def sources(self):
+        return sorted(p.name for p in (self.root / 'segments').glob('*'))
+
+    def find_segments(self, sources=None, since=None, until=None):
+        """Returns the segments which may contain matching lines, grouped by
+        source and ordered by time."""
+        segments = {}
+        wanted = None if sources is None else {sanitize_source(s) for s in sources}
+
+        for entry in self.read_index():
+            if wanted is not None and entry['source'] not in wanted:
+                continue
+            if since is not None and entry['end'] < since:
+                continue
+            if until is not None and entry['start'] > until:
+                continue
+            segments.setdefault(entry['source'], []).append((entry['start'], entry['path']))
+
+        for path in self.unindexed_segments():
+            source = Path(path).parent.name
+            if wanted is not None and source not in wanted:
+                continue
+            start = float(Path(path).name[:-len('.gz')])
+            if until is not None and start > until:
+                continue
+            segments.setdefault(source, []).append((start, path))
+
+        return {source: [path for _, path in sorted(paths)] for source, paths in segments.items()}
+
+    def query(self, sources=None, since=None, until=None, pattern=None):
+        """Yields (timestamp, source, line) for matching lines in time order.
+        Only one segment per source is open at a time."""
+        regex = re.compile(pattern) if pattern is not None else None
+
+        def iter_source(source, paths):
+            for path in paths:
+                for timestamp, line in read_segment(self.root / path):
+                    if since is not None and timestamp < since:
+                        continue
+                    if until is not None and timestamp > until:
+                        continue
+                    if regex is not None and not regex.search(line):
+                        continue
+                    yield timestamp, source, line
+
+        iters = [iter_source(source, paths) for source, paths in self.find_segments(sources, since, until).items()]
+        return heapq.merge(*iters, key=lambda item: item[0])
+
+
+def read_segment(path):
+    """Yields (timestamp, line) from a segment. Segments which are still being
+    written or were truncated are read up to their last complete flush."""
+    try:
+        f = gzip.open(path, 'rb')
+    except FileNotFoundError:
+        return
+    with f:
+        try:
+            for raw in f:
+                timestamp, _, line = raw.decode(errors='replace').rstrip('\n').partition('\t')
+                try:
+                    timestamp = float(timestamp)
+                except ValueError:
+                    continue
+                yield timestamp, line
+        except (EOFError, zlib.error, gzip.BadGzipFile):
+            pass
@@ -0,0 +1,238 @@
+"""
+CPU and memory placement for plugin containers.
+
+Each core on the docker host is a bin holding one CPU. The first cores are
+reserved for the core services, like rabbitmq and stage-messages, and plugins
+are packed onto the rest. A plugin requesting c CPUs gets int(c) free cores
+to itself plus the fullest core which still has room for the fraction, so
+partly used cores are filled before new ones are started. The container is
+pinned to those cores with --cpuset-cpus and limited to c CPUs with --cpus.
+Memory requests are checked against what's left after the reservation and
+applied with --memory.
+
+Plugins which don't request resources in sage.json aren't limited. They can
+use any core which isn't reserved.
+
+Allocations are kept in a file per project, so runs in other terminals see
+each other's placements. Allocations owned by processes which have exited are
+dropped whenever the file is loaded.
+"""
+import fcntl
+import json
+import os
+import re
+import subprocess
+from contextlib import contextmanager
+from pathlib import Path
+
+
+PLACEMENTS_DIR = Path('.virtual-waggle/placements')
+
+# tolerance for summing fractional cpu shares
+EPSILON = 1e-6
+
+
+class PlacementError(Exception):
+    pass
+
+
+def parse_memory(value):
+    """Parses a memory size like 536870912, "512M" or "1.5G" into bytes."""
+    if isinstance(value, int):
+        return value
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)\s*([KMG]?)i?B?', str(value).strip(), re.IGNORECASE)
+    if match is None:
+        raise ValueError(f'invalid memory size {value!r}')
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** ' KMG'.index(unit.upper() or ' '))
+
+
+def format_memory(size):
+    for unit, scale in [('G', 1024 ** 3), ('M', 1024 ** 2), ('K', 1024)]:
+        if size >= scale:
+            return f'{size / scale:.4g}{unit}'
+    return f'{size}B'
+
+
+def get_resource_request(config):
+    """Returns the cpu and memory requested by the resources section of
+    sage.json. For example:
+
+    "resources": {
+        "cpu": 1.5,
+        "memory": "512M"
+    }
+
+    Either may be left out, in which case it's None.
+    """
+    resources = config.get('resources', {})
+
+    cpu = resources.get('cpu')
+    if cpu is not None:
+        if isinstance(cpu, bool) or not isinstance(cpu, (int, float)) or cpu <= 0:
+            raise ValueError('sage.json field "resources.cpu" must be a positive number.')
+        cpu = float(cpu)
+
+    memory = resources.get('memory')
+    if memory is not None:
+        memory = parse_memory(memory)
+        if memory <= 0:
+            raise ValueError('sage.json field "resources.memory" must be positive.')
+
+    return {'cpu': cpu, 'memory': memory}
+
+
+def get_node_capacity():
+    """Returns the number of cpus and bytes of memory on the docker host."""
+    output = subprocess.check_output(['docker', 'info', '--format', '{{.NCPU}} {{.MemTotal}}'])
+    cpus, memory = output.decode().split()
+    return int(cpus), int(memory)
+
+
+def pack(free, cpu):
+    """Returns the {core: share} taken to place cpu on the free capacity of
+    each core or None if it doesn't fit."""
+    whole = int(cpu + EPSILON)
+    fraction = cpu - whole
+
+    empty = [core for core in sorted(free) if free[core] >= 1 - EPSILON]
+    if len(empty) < whole:
+        return None
+
+    taken = {core: 1.0 for core in empty[:whole]}
+
+    if fraction > EPSILON:
+        candidates = [(free[core], core) for core in sorted(free) if core not in taken and free[core] >= fraction - EPSILON]
+        if not candidates:
+            return None
+        # best fit: the fullest core with room for the fraction
+        _, core = min(candidates)
+        taken[core] = fraction
+
+    return taken
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Placements:
+
+    def __init__(self, path, cpus, memory, reserved_cpus, reserved_memory):
+        self.path = Path(path)
+        # always leave at least one core for plugins
+        self.reserved_cpus = max(min(reserved_cpus, cpus - 1), 0)
+        self.plugin_cores = list(range(self.reserved_cpus, cpus))
+        self.memory = max(memory - reserved_memory, 0)
+
+    @classmethod
+    def for_project(cls, project_name, reserved_cpus, reserved_memory):
+        cpus, memory = get_node_capacity()
+        return cls(PLACEMENTS_DIR / f'{project_name}.json', cpus, memory, reserved_cpus, reserved_memory)
+
+    @contextmanager
+    def locked(self):
+        """Yields the current allocations and saves them afterwards, holding
+        a lock so concurrent runs don't place onto the same capacity."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        with open(self.path.with_suffix('.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            try:
+                allocations = json.loads(self.path.read_text())
+            except (FileNotFoundError, ValueError):
+                allocations = {}
+
+            allocations = {name: a for name, a in allocations.items() if is_process_alive(a['pid'])}
+
+            yield allocations
+
+            tmp = self.path.with_suffix('.tmp')
+            tmp.write_text(json.dumps(allocations, indent=2))
+            os.replace(tmp, self.path)
+
+    def get_free(self, allocations):
+        free = {core: 1.0 for core in self.plugin_cores}
+        memory = self.memory
+        for allocation in allocations.values():
+            for core, share in allocation['cores'].items():
+                if int(core) in free:
+                    free[int(core)] -= share
+            memory -= allocation['memory'] or 0
+        return free, memory
+
+    def place(self, names, request):
+        """Places each of the named containers with the requested resources.
+        Returns an allocation for each name or raises PlacementError if they
+        don't all fit."""
+        if not self.plugin_cores:
+            raise PlacementError('No cores available for plugins.')
+
+        with self.locked() as allocations:
+            free, free_memory = self.get_free(allocations)
+            placed = []
+
+            for name in names:
+                cores = {}
+
+                if request['cpu'] is not None:
+                    cores = pack(free, request['cpu'])
+                    if cores is None:
+                        raise PlacementError(
+                            f'Not enough free CPU to place {name} requesting {request["cpu"]:g} cpus. '
+                            f'{sum(free.values()):.2f} of {len(self.plugin_cores)} plugin cpus are free.')
+                    for core, share in cores.items():
+                        free[core] -= share
+
+                if request['memory'] is not None:
+                    if request['memory'] > free_memory:
+                        raise PlacementError(
+                            f'Not enough free memory to place {name} requesting {format_memory(request["memory"])}. '
+                            f'{format_memory(max(free_memory, 0))} of {format_memory(self.memory)} is free.')
+                    free_memory -= request['memory']
+
+                placed.append((name, {
+                    'pid': os.getpid(),
+                    'cpu': request['cpu'],
+                    'cores': {str(core): share for core, share in cores.items()},
+                    'memory': request['memory'],
+                }))
+
+            # only record the allocations once everything fits
+            allocations.update(placed)
+
+        return [allocation for _, allocation in placed]
+
+    def release(self, names):
+        with self.locked() as allocations:
+            for name in names:
+                allocations.pop(name, None)
+
+    def get_docker_args(self, allocation):
+        if allocation['cores']:
+            cores = sorted(map(int, allocation['cores']))
+        else:
+            cores = self.plugin_cores
+
+        args = ['--cpuset-cpus', ','.join(map(str, cores))]
+
+        if allocation['cpu'] is not None:
+            args += ['--cpus', f'{allocation["cpu"]:g}']
+        if allocation['memory'] is not None:
+            args += ['--memory', str(allocation['memory'])]
+
+        return args
+
+
+def describe(allocation):
+    cores = ','.join(sorted(allocation['cores'], key=int)) or 'any plugin core'
+    cpu = f'{allocation["cpu"]:g} cpus' if allocation['cpu'] is not None else 'unlimited cpu'
+    memory = format_memory(allocation['memory']) if allocation['memory'] is not None else 'unlimited memory'
+    return f'{cpu} on {cores}, {memory}'
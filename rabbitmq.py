@@ -0,0 +1,169 @@
+import base64
+import http.client
+import json
+import subprocess
+import threading
+from urllib.parse import quote
+
+
+class ManagementError(Exception):
+    pass
+
+
+class ManagementClient:
+    """Client for the RabbitMQ management API which reuses a single keep-alive
+    connection for all requests. It may be shared between threads, in which
+    case their requests take turns on the connection."""
+
+    def __init__(self, host, port=15672, username='admin', password='admin', timeout=5):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        token = base64.b64encode(f'{username}:{password}'.encode()).decode()
+        self.headers = {
+            'Authorization': f'Basic {token}',
+            'Content-Type': 'application/json',
+        }
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+
+        with self.lock:
+            resp, content = self.send(method, path, data)
+
+        if resp.status >= 400:
+            raise ManagementError(f'{method} {path} failed with status {resp.status}: {content.decode(errors="replace")}')
+
+        return json.loads(content) if content else None
+
+    def send(self, method, path, data):
+        # retry once in case the server closed an idle keep-alive connection
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self.conn.request(method, '/api' + path, body=data, headers=self.headers)
+                resp = self.conn.getresponse()
+                return resp, resp.read()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                self.close()
+                if attempt == 1:
+                    raise
+            except OSError:
+                self.close()
+                raise
+
+    def get(self, path):
+        return self.request('GET', path)
+
+    def put(self, path, body):
+        return self.request('PUT', path, body)
+
+    def delete(self, path):
+        return self.request('DELETE', path)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def setup_user(self, username, password, vhost='/', tags=''):
+        """Creates the user or updates its password and grants it full
+        permissions on vhost."""
+        self.put(f'/users/{quote(username, safe="")}', {
+            'password': password,
+            'tags': tags,
+        })
+        self.put(f'/permissions/{quote(vhost, safe="")}/{quote(username, safe="")}', {
+            'configure': '.*',
+            'write': '.*',
+            'read': '.*',
+        })
+
+    def delete_user(self, username):
+        self.delete(f'/users/{quote(username, safe="")}')
+
+
+def get_service_address(project_name, service, network='waggle'):
+    """Returns the IP address of a compose service on the project network or
+    None if the service isn't running."""
+    output = subprocess.check_output([
+        'docker', 'ps', '-q',
+        '--filter', f'label=com.docker.compose.project={project_name}',
+        '--filter', f'label=com.docker.compose.service={service}',
+    ]).decode().split()
+
+    if not output:
+        return None
+
+    address = subprocess.check_output([
+        'docker', 'inspect',
+        '-f', f'{{{{ with index .NetworkSettings.Networks "{project_name}_{network}" }}}}{{{{ .IPAddress }}}}{{{{ end }}}}',
+        output[0],
+    ]).decode().strip()
+
+    return address or None
+
+
+def get_published_address(project_name, service, port):
+    """Returns the (host, port) a compose service's port is published on or
+    None if it isn't published."""
+    try:
+        output = subprocess.check_output(
+            ['docker-compose', '-p', project_name, 'port', service, str(port)],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    host, _, published = output.rpartition(':')
+    if not published.isdigit():
+        return None
+    if host in ('', '0.0.0.0', '::', '[::]'):
+        host = '127.0.0.1'
+    return host, int(published)
+
+
+def connect(project_name, timeout=5, probe_timeout=1):
+    """Returns a management API client for the project's rabbitmq service.
+
+    The API is published on localhost when running with --debug, in which
+    case that's tried first. Otherwise, it is reached through the container's
+    address on the project network, which only works where the host can route
+    to containers, such as on Linux. Localhost is never tried unless the
+    project publishes it, so we can't end up talking to another project's
+    broker.
+    """
+    candidates = []
+
+    published = get_published_address(project_name, 'rabbitmq', 15672)
+    if published is not None:
+        candidates.append(published)
+
+    try:
+        address = get_service_address(project_name, 'rabbitmq')
+    except (OSError, subprocess.CalledProcessError):
+        address = None
+
+    if address is not None:
+        candidates.append((address, 15672))
+
+    for host, port in candidates:
+        client = ManagementClient(host, port, timeout=probe_timeout)
+        try:
+            client.get('/whoami')
+        except (OSError, ManagementError):
+            client.close()
+            continue
+        client.timeout = timeout
+        client.conn.sock.settimeout(timeout)
+        return client
+
+    raise ManagementError('RabbitMQ management API is not reachable.')
@@ -0,0 +1,168 @@
+"""
+Append-only recording of AMQP messages with an offset index.
+
+A recording is a data file and an index file next to it. The data file
+starts with MAGIC, followed by one record per message:
+
+    time_ns     u64  unix time the message was received
+    user_len    u8
+    key_len     u8
+    props_len   u32
+    body_len    u32
+    user_id     user_len bytes
+    routing_key key_len bytes
+    properties  props_len bytes of AMQP encoded basic properties
+    body        body_len bytes
+
+The user ID is stored outside the encoded properties, so replay can filter
+by plugin without decoding them. The index file holds a (time_ns, offset)
+pair for each record. Both files are only ever appended to. After a crash,
+index entries for records which didn't reach the data file are dropped and
+a missing or short index is rebuilt by scanning the data file.
+
+The last byte before the newline in MAGIC is the format version. Version 1
+stored props_len as a u16, which a large headers table can overflow.
+"""
+import mmap
+import os
+import struct
+from pathlib import Path
+
+
+MAGIC = b'VWREC\x00\x02\n'
+RECORD = struct.Struct('>QBBII')
+INDEX = struct.Struct('>QQ')
+
+
+def get_index_path(path):
+    return Path(str(path) + '.idx')
+
+
+class RecordingWriter:
+
+    def __init__(self, path):
+        self.path = Path(path)
+        # recordings are never reopened for writing, so a torn record left
+        # by a crash is always at the end of the file.
+        self.data = open(self.path, 'xb')
+        self.data.write(MAGIC)
+        self.index = open(get_index_path(self.path), 'wb')
+        self.count = 0
+
+    def write(self, time_ns, user_id, routing_key, properties, body):
+        user = user_id.encode()
+        key = routing_key.encode()
+        offset = self.data.tell()
+        self.data.write(RECORD.pack(time_ns, len(user), len(key), len(properties), len(body)))
+        self.data.write(user)
+        self.data.write(key)
+        self.data.write(properties)
+        self.data.write(body)
+        self.index.write(INDEX.pack(time_ns, offset))
+        self.count += 1
+
+    def flush(self):
+        # data first, so the index never gets ahead of it
+        self.data.flush()
+        self.index.flush()
+
+    def close(self):
+        self.flush()
+        self.data.close()
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Recording:
+    """Memory mapped view of a recording. Records are read straight from the
+    mapping, so only the pages which are replayed are ever read from disk."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.file = open(self.path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+
+        if size < len(MAGIC):
+            raise ValueError(f'{path} is not a recording')
+
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.data[:len(MAGIC)] != MAGIC:
+            header = self.data[:len(MAGIC)]
+            self.close()
+            if header[:6] == MAGIC[:6]:
+                raise ValueError(f'{path} is a version {header[6]} recording. This version of capture only reads version {MAGIC[6]}.')
+            raise ValueError(f'{path} is not a recording')
+
+        self.index = self.load_index()
+
+    def load_index(self):
+        try:
+            raw = get_index_path(self.path).read_bytes()
+        except FileNotFoundError:
+            raw = b''
+
+        entries = [e for e in INDEX.iter_unpack(raw[:len(raw) - len(raw) % INDEX.size])]
+
+        # drop entries for records which didn't make it to disk
+        while entries and self.record_end(entries[-1][1]) is None:
+            entries.pop()
+
+        # rebuild the tail of the index from the data file
+        offset = self.record_end(entries[-1][1]) if entries else len(MAGIC)
+        while True:
+            end = self.record_end(offset)
+            if end is None:
+                break
+            entries.append((RECORD.unpack_from(self.data, offset)[0], offset))
+            offset = end
+
+        return entries
+
+    def record_end(self, offset):
+        """Returns the offset after the record at offset or None if it's
+        incomplete."""
+        if offset + RECORD.size > len(self.data):
+            return None
+        _, user_len, key_len, props_len, body_len = RECORD.unpack_from(self.data, offset)
+        end = offset + RECORD.size + user_len + key_len + props_len + body_len
+        return end if end <= len(self.data) else None
+
+    def __len__(self):
+        return len(self.index)
+
+    def user_id(self, offset):
+        user_len = self.data[offset + 8]
+        start = offset + RECORD.size
+        return self.data[start:start + user_len].decode()
+
+    def read(self, offset):
+        """Returns the (time_ns, user_id, routing_key, properties, body) of
+        the record at offset."""
+        time_ns, user_len, key_len, props_len, body_len = RECORD.unpack_from(self.data, offset)
+        pos = offset + RECORD.size
+        user = self.data[pos:pos + user_len].decode()
+        pos += user_len
+        key = self.data[pos:pos + key_len].decode()
+        pos += key_len
+        properties = self.data[pos:pos + props_len]
+        pos += props_len
+        body = self.data[pos:pos + body_len]
+        return time_ns, user, key, properties, body
+
+    def close(self):
+        if getattr(self, 'data', None) is not None:
+            self.data.close()
+            self.data = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
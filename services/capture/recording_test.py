@@ -0,0 +1,133 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from recording import INDEX, Recording, RecordingWriter, get_index_path
+
+
+def write_recording(path, count):
+    offsets = []
+    with RecordingWriter(path) as writer:
+        for i in range(count):
+            offsets.append(writer.data.tell())
+            writer.write(1000 + i, f'plugin-{i % 3}-1.0.0-0', 'a.b', b'\x00' * i, f'message {i}'.encode())
+    return offsets
+
+
+class TestRecording(unittest.TestCase):
+
+    def test_read(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = Path(dir, 'test.rec')
+            offsets = write_recording(path, 10)
+
+            with Recording(path) as recording:
+                self.assertEqual(recording.index, [(1000 + i, offset) for i, offset in enumerate(offsets)])
+                for i, (_, offset) in enumerate(recording.index):
+                    time_ns, user_id, routing_key, properties, body = recording.read(offset)
+                    self.assertEqual(time_ns, 1000 + i)
+                    self.assertEqual(user_id, f'plugin-{i % 3}-1.0.0-0')
+                    self.assertEqual(recording.user_id(offset), user_id)
+                    self.assertEqual(routing_key, 'a.b')
+                    self.assertEqual(properties, b'\x00' * i)
+                    self.assertEqual(body, f'message {i}'.encode())
+
+    def test_empty_user_id(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = Path(dir, 'test.rec')
+            with RecordingWriter(path) as writer:
+                writer.write(1, '', 'a.b', b'', b'body')
+
+            with Recording(path) as recording:
+                offset = recording.index[0][1]
+                self.assertEqual(recording.user_id(offset), '')
+                self.assertEqual(recording.read(offset)[1], '')
+
+    def test_large_properties(self):
+        # a large headers table can encode to more than 64K
+        properties = bytes(range(256)) * 300
+        with tempfile.TemporaryDirectory() as dir:
+            path = Path(dir, 'test.rec')
+            with RecordingWriter(path) as writer:
+                writer.write(1, 'plugin-1-1.0.0-0', 'a.b', properties, b'body')
+                writer.write(2, 'plugin-1-1.0.0-0', 'a.b', b'', b'next')
+
+            with Recording(path) as recording:
+                self.assertEqual(len(recording), 2)
+                self.assertEqual(recording.read(recording.index[0][1])[3], properties)
+                self.assertEqual(recording.read(recording.index[1][1])[4], b'next')
+
+    def test_torn_data(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = Path(dir, 'test.rec')
+            offsets = write_recording(path, 10)
+
+            # cut the last record in half. its index entry is still there.
+            with open(path, 'r+b') as file:
+                file.truncate(offsets[-1] + 20)
+
+            with Recording(path) as recording:
+                self.assertEqual(len(recording), 9)
+                self.assertEqual([offset for _, offset in recording.index], offsets[:9])
+                self.assertEqual(recording.read(offsets[8])[4], b'message 8')
+
+    def test_torn_index(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = Path(dir, 'test.rec')
+            offsets = write_recording(path, 10)
+
+            # cut the index partway through an entry, so the tail has to be
+            # rebuilt from the data file.
+            index_path = get_index_path(path)
+            with open(index_path, 'r+b') as file:
+                file.truncate(4 * INDEX.size + INDEX.size // 2)
+
+            with Recording(path) as recording:
+                self.assertEqual(recording.index, [(1000 + i, offset) for i, offset in enumerate(offsets)])
+
+    def test_missing_index(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = Path(dir, 'test.rec')
+            offsets = write_recording(path, 10)
+            get_index_path(path).unlink()
+
+            with Recording(path) as recording:
+                self.assertEqual([offset for _, offset in recording.index], offsets)
+
+    def test_torn_data_and_index(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = Path(dir, 'test.rec')
+            offsets = write_recording(path, 10)
+
+            with open(path, 'r+b') as file:
+                file.truncate(offsets[6] + 3)
+            with open(get_index_path(path), 'r+b') as file:
+                file.truncate(3 * INDEX.size + 1)
+
+            with Recording(path) as recording:
+                self.assertEqual([offset for _, offset in recording.index], offsets[:6])
+
+    def test_not_a_recording(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = Path(dir, 'test.rec')
+            path.write_bytes(b'something else entirely')
+            with self.assertRaises(ValueError):
+                Recording(path)
+
+    def test_old_version(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = Path(dir, 'test.rec')
+            path.write_bytes(b'VWREC\x00\x01\n' + bytes(16))
+            with self.assertRaisesRegex(ValueError, 'version 1'):
+                Recording(path)
+
+    def test_writer_does_not_overwrite(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = Path(dir, 'test.rec')
+            write_recording(path, 1)
+            with self.assertRaises(FileExistsError):
+                RecordingWriter(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,314 @@
+"""
+End-to-end load generator for the node message path.
+
+Synthetic publishers send waggle messages to the messages exchange as plugin
+users, the same way plugins do. Each message carries its send time and the
+load step it belongs to. A consumer reads them back from a stand-in for the
+beehive exchange, so latency covers staging, to-beehive and the shovel.
+
+The offered load is ramped through a list of total message rates. For each
+step, sustained throughput and end-to-end latency percentiles are recorded.
+The saturation point is the first step where the path no longer keeps up.
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import struct
+import sys
+import threading
+import time
+
+import pika
+import waggle.protocol
+
+
+MARKER = b'VWLT'
+STAMP = struct.Struct('>4sQIQ')
+
+# a step is saturated when it delivers less than this fraction of what was
+# sent or its p99 latency grows past this multiple of the first step's.
+SATURATION_THROUGHPUT_FRACTION = 0.9
+SATURATION_LATENCY_FACTOR = 10
+
+
+def make_payload(size, step, seq):
+    stamp = STAMP.pack(MARKER, time.time_ns(), step, seq)
+    body = stamp + bytes(max(size - len(stamp), 0))
+    return waggle.protocol.pack_waggle_packets([{
+        'body': waggle.protocol.pack_datagrams([{'body': body}]),
+    }])
+
+
+def read_stamp(body):
+    # staging rewrites header fields but leaves datagram bodies intact, so we
+    # can find the stamp without unpacking the message.
+    offset = body.find(MARKER)
+    if offset < 0 or offset + STAMP.size > len(body):
+        return None
+    _, sent_ns, step, seq = STAMP.unpack_from(body, offset)
+    return sent_ns, step, seq
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+class Publisher(threading.Thread):
+
+    def __init__(self, url, username, password, exchange, payload_size, schedule):
+        super().__init__(daemon=True)
+        self.params = pika.URLParameters(url)
+        self.params.credentials = pika.PlainCredentials(username, password)
+        self.username = username
+        self.exchange = exchange
+        self.payload_size = payload_size
+        self.schedule = schedule
+        self.sent = [0] * len(schedule.rates)
+        self.error = None
+
+    def run(self):
+        try:
+            self.publish()
+        except Exception as exc:
+            logging.exception('publisher %s failed', self.username)
+            self.error = str(exc)
+
+    def publish(self):
+        connection = pika.BlockingConnection(self.params)
+        channel = connection.channel()
+        properties = pika.BasicProperties(user_id=self.username, delivery_mode=2)
+        seq = 0
+
+        for step, rate in enumerate(self.schedule.rates):
+            interval = self.schedule.publishers / rate
+            start, end = self.schedule.window(step)
+            next_send = start
+
+            while True:
+                now = time.monotonic()
+                if now >= end:
+                    break
+                if now < next_send:
+                    time.sleep(min(next_send - now, end - now))
+                    continue
+                channel.basic_publish(self.exchange, '', make_payload(self.payload_size, step, seq), properties)
+                self.sent[step] += 1
+                seq += 1
+                # if we fall behind, don't burst to catch up
+                next_send = max(next_send + interval, now - interval)
+
+        connection.close()
+
+
+class Consumer(threading.Thread):
+
+    def __init__(self, url, queue, num_steps):
+        super().__init__(daemon=True)
+        self.params = pika.URLParameters(url)
+        self.queue = queue
+        self.latencies = [[] for _ in range(num_steps)]
+        self.receive_times = []
+        self.received = 0
+        self.ready = threading.Event()
+        self.stopping = threading.Event()
+        self.error = None
+
+    def run(self):
+        try:
+            self.consume()
+        except Exception as exc:
+            logging.exception('consumer failed')
+            self.error = str(exc)
+        finally:
+            # main waits for this before publishing, so set it even if we
+            # never connected.
+            self.ready.set()
+
+    def consume(self):
+        connection = pika.BlockingConnection(self.params)
+        channel = connection.channel()
+        channel.basic_qos(prefetch_count=1000)
+        self.ready.set()
+
+        for method, properties, body in channel.consume(self.queue, auto_ack=True, inactivity_timeout=0.5):
+            if self.stopping.is_set():
+                break
+            if body is None:
+                continue
+            stamp = read_stamp(body)
+            if stamp is None:
+                continue
+            sent_ns, step, _ = stamp
+            if step < len(self.latencies):
+                self.latencies[step].append((time.time_ns() - sent_ns) / 1e9)
+            self.receive_times.append(time.monotonic())
+            self.received += 1
+
+        connection.close()
+
+
+class Schedule:
+
+    def __init__(self, rates, publishers, step_duration):
+        self.rates = rates
+        self.publishers = publishers
+        self.step_duration = step_duration
+        self.start = time.monotonic() + 1.0
+
+    def window(self, step):
+        start = self.start + step * self.step_duration
+        return start, start + self.step_duration
+
+
+def summarize(schedule, publishers, consumer):
+    steps = []
+    baseline_p99 = None
+    saturation = None
+
+    for step, rate in enumerate(schedule.rates):
+        start, end = schedule.window(step)
+        sent = sum(p.sent[step] for p in publishers)
+        latencies = consumer.latencies[step]
+        received_in_window = sum(1 for t in consumer.receive_times if start <= t < end)
+        p99 = percentile(latencies, 99)
+
+        result = {
+            'offered_rate': rate,
+            'send_rate': sent / schedule.step_duration,
+            'throughput': received_in_window / schedule.step_duration,
+            'sent': sent,
+            'received': len(latencies),
+            'lost': sent - len(latencies),
+            'latency': {
+                'p50': percentile(latencies, 50),
+                'p90': percentile(latencies, 90),
+                'p99': p99,
+                'max': max(latencies, default=None),
+                'mean': statistics.mean(latencies) if latencies else None,
+            },
+        }
+
+        if baseline_p99 is None:
+            baseline_p99 = p99
+
+        saturated = (
+            result['throughput'] < SATURATION_THROUGHPUT_FRACTION * result['send_rate'] or
+            (p99 is not None and baseline_p99 and p99 > SATURATION_LATENCY_FACTOR * baseline_p99))
+
+        result['saturated'] = saturated
+        steps.append(result)
+
+        if saturated and saturation is None:
+            previous = steps[-2] if len(steps) > 1 else None
+            saturation = {
+                'offered_rate': rate,
+                'max_sustained_throughput': previous['throughput'] if previous else None,
+            }
+
+    return steps, saturation
+
+
+def print_summary(steps, saturation):
+    def ms(value):
+        return f'{value * 1000:.1f}' if value is not None else '-'
+
+    print(f'{"offered/s":>10} {"sent/s":>10} {"recv/s":>10} {"lost":>8} {"p50 ms":>8} {"p90 ms":>8} {"p99 ms":>8} {"max ms":>8}')
+    for s in steps:
+        lat = s['latency']
+        mark = ' *' if s['saturated'] else ''
+        print(f'{s["offered_rate"]:>10.0f} {s["send_rate"]:>10.1f} {s["throughput"]:>10.1f} {s["lost"]:>8} '
+              f'{ms(lat["p50"]):>8} {ms(lat["p90"]):>8} {ms(lat["p99"]):>8} {ms(lat["max"]):>8}{mark}')
+
+    if saturation is None:
+        print('\nDid not saturate. Try higher rates.')
+    else:
+        print(f'\nSaturated at {saturation["offered_rate"]} msg/s offered (marked *).', end='')
+        if saturation['max_sustained_throughput'] is not None:
+            print(f' Max sustained throughput {saturation["max_sustained_throughput"]:.1f} msg/s.')
+        else:
+            print()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='amqp://rabbitmq', help='broker url')
+    parser.add_argument('--users', default=os.environ.get('LOADTEST_USERS'), help='json list of [username, password] for each publisher')
+    parser.add_argument('--exchange', default='messages', help='exchange to publish to')
+    parser.add_argument('--consume-from', default='loadtest-beehive', help='queue to read delivered messages from')
+    parser.add_argument('--consumer-credentials', default='worker:worker', help='username:password for the consumer')
+    parser.add_argument('--rates', default='100,200,500,1000,2000', help='total message rates to step through')
+    parser.add_argument('--step-duration', type=float, default=10, help='seconds per rate step')
+    parser.add_argument('--payload-size', type=int, default=100, help='size of each message payload in bytes')
+    parser.add_argument('--drain-timeout', type=float, default=30, help='seconds to wait for outstanding messages after the last step')
+    parser.add_argument('-o', '--output', help='write results as json to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    if not args.users:
+        parser.error('no publisher users given')
+
+    users = json.loads(args.users)
+    rates = [float(r) for r in args.rates.split(',')]
+
+    username, _, password = args.consumer_credentials.partition(':')
+    consumer = Consumer(args.url, args.consume_from, len(rates))
+    consumer.params.credentials = pika.PlainCredentials(username, password)
+    consumer.start()
+    consumer.ready.wait()
+
+    if consumer.error:
+        logging.error('could not consume from %s: %s', args.consume_from, consumer.error)
+        sys.exit(1)
+
+    schedule = Schedule(rates, len(users), args.step_duration)
+    publishers = [Publisher(args.url, u, p, args.exchange, args.payload_size, schedule) for u, p in users]
+
+    logging.info('running %d publishers at %s msg/s for %.0fs each', len(users), args.rates, args.step_duration)
+
+    for p in publishers:
+        p.start()
+    for p in publishers:
+        p.join()
+
+    # wait for messages still in flight
+    total_sent = sum(sum(p.sent) for p in publishers)
+    deadline = time.monotonic() + args.drain_timeout
+    while consumer.received < total_sent and time.monotonic() < deadline:
+        time.sleep(0.2)
+
+    consumer.stopping.set()
+    consumer.join(timeout=5)
+
+    steps, saturation = summarize(schedule, publishers, consumer)
+    print_summary(steps, saturation)
+
+    results = {
+        'time': time.time(),
+        'config': {
+            'publishers': len(users),
+            'rates': rates,
+            'step_duration': args.step_duration,
+            'payload_size': args.payload_size,
+            'consume_from': args.consume_from,
+        },
+        'steps': steps,
+        'saturation': saturation,
+        'errors': [t.error for t in publishers + [consumer] if t.error],
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if results['errors']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import types
+import unittest
+from unittest import mock
+
+try:
+    import loadtest
+except ImportError:
+    loadtest = None
+
+
+def make_run(rates, sent, received, latency, step_duration=1.0):
+    """Returns the schedule, publishers and consumer of a finished run where
+    each step's messages were received evenly across its window."""
+    schedule = types.SimpleNamespace(rates=rates, step_duration=step_duration,
+                                     window=lambda step: (step * step_duration, (step + 1) * step_duration))
+    publishers = [types.SimpleNamespace(sent=list(sent))]
+    consumer = types.SimpleNamespace(latencies=[], receive_times=[])
+    for step, (count, seconds) in enumerate(zip(received, latency)):
+        consumer.latencies.append([seconds] * count)
+        consumer.receive_times += [step * step_duration + i * step_duration / count for i in range(count)]
+    return schedule, publishers, consumer
+
+
+@unittest.skipUnless(loadtest, 'requires pika and pywaggle')
+class TestLoadTest(unittest.TestCase):
+
+    def test_percentile(self):
+        values = list(range(100, 0, -1))
+        self.assertIsNone(loadtest.percentile([], 50))
+        self.assertEqual(loadtest.percentile([7], 99), 7)
+        self.assertEqual(loadtest.percentile(values, 0), 1)
+        self.assertEqual(loadtest.percentile(values, 50), 51)
+        self.assertEqual(loadtest.percentile(values, 99), 100)
+        self.assertEqual(loadtest.percentile(values, 100), 100)
+
+    def test_consumer_error(self):
+        consumer = loadtest.Consumer('amqp://rabbitmq', 'loadtest-beehive', 1)
+        with mock.patch.object(loadtest.pika, 'BlockingConnection', side_effect=OSError('connection refused')):
+            consumer.run()
+
+        # main waits on ready, so it has to be set even though we failed
+        self.assertTrue(consumer.ready.is_set())
+        self.assertEqual(consumer.error, 'connection refused')
+
+    def test_throughput_saturation(self):
+        steps, saturation = loadtest.summarize(*make_run(
+            rates=[100, 200, 400],
+            sent=[100, 200, 400],
+            received=[100, 200, 300],
+            latency=[0.01, 0.02, 0.05]))
+
+        self.assertEqual([s['saturated'] for s in steps], [False, False, True])
+        self.assertEqual([s['lost'] for s in steps], [0, 0, 100])
+        self.assertEqual(steps[2]['throughput'], 300)
+        self.assertEqual(saturation, {'offered_rate': 400, 'max_sustained_throughput': 200})
+
+    def test_latency_saturation(self):
+        # everything arrives, but p99 grows past 10x the first step's
+        steps, saturation = loadtest.summarize(*make_run(
+            rates=[100, 200, 400],
+            sent=[100, 200, 400],
+            received=[100, 200, 400],
+            latency=[0.01, 0.2, 0.3]))
+
+        self.assertEqual([s['saturated'] for s in steps], [False, True, True])
+        self.assertEqual(saturation, {'offered_rate': 200, 'max_sustained_throughput': 100})
+
+    def test_saturated_first_step(self):
+        _, saturation = loadtest.summarize(*make_run(
+            rates=[100, 200],
+            sent=[100, 200],
+            received=[50, 100],
+            latency=[0.01, 0.01]))
+
+        self.assertEqual(saturation, {'offered_rate': 100, 'max_sustained_throughput': None})
+
+    def test_not_saturated(self):
+        steps, saturation = loadtest.summarize(*make_run(
+            rates=[100, 200],
+            sent=[100, 200],
+            received=[100, 200],
+            latency=[0.01, 0.02]))
+
+        self.assertFalse(any(s['saturated'] for s in steps))
+        self.assertIsNone(saturation)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,306 @@
+"""
+Playback server which mocks out the network cameras attached to a node.
+
+Serves the following endpoints from the data directory:
+
+    /{camera}/live.mp4   video file with range request support
+    /{camera}/image.jpg  next image from /{camera}/images, optionally at a fixed fps
+    /blank.jpg           solid black image
+    /noise.jpg           random noise image
+    /{path}              any other file in the data directory
+
+Files are sent using sendfile and connections are kept alive between
+requests. Frames from image sequences are kept in an LRU cache, so polling
+plugins don't reread them from disk.
+"""
+import argparse
+import email.utils
+import io
+import logging
+import mimetypes
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import unquote, urlparse
+
+
+IMAGE_SUFFIXES = {'.jpg', '.jpeg', '.png'}
+NOISE_FRAMES = 8
+
+
+class FrameCache:
+    """LRU cache of file contents bounded by total size. Entries are keyed by
+    path, size and mtime, so changed files are reread."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        st = os.stat(path)
+        key = (path, st.st_size, st.st_mtime_ns)
+
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                return data, st
+
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        if len(data) > self.max_bytes:
+            return data, st
+
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = data
+                self.size += len(data)
+            while self.size > self.max_bytes:
+                _, old = self.entries.popitem(last=False)
+                self.size -= len(old)
+
+        return data, st
+
+
+class ImageSequence:
+    """Cycles through the images in a directory. With fps set, the frame is
+    chosen by the time since the sequence started, so every client sees the
+    same frame at the same time regardless of how often it polls. Otherwise,
+    each request gets the next frame."""
+
+    def __init__(self, dir, fps):
+        self.dir = dir
+        self.fps = fps
+        self.start = time.monotonic()
+        self.counter = 0
+        self.lock = threading.Lock()
+        self.frames = []
+        self.scanned_mtime = None
+
+    def scan(self):
+        # rescan only when the directory changes. a camera without an images
+        # directory, or one which was removed, just has no frames.
+        try:
+            mtime = os.stat(self.dir).st_mtime_ns
+            if mtime != self.scanned_mtime:
+                self.frames = sorted(p for p in self.dir.iterdir() if p.suffix.lower() in IMAGE_SUFFIXES)
+                self.scanned_mtime = mtime
+        except OSError:
+            self.frames = []
+            self.scanned_mtime = None
+
+    def next_frame(self):
+        with self.lock:
+            self.scan()
+            if not self.frames:
+                return None
+            if self.fps > 0:
+                index = int((time.monotonic() - self.start) * self.fps)
+            else:
+                index = self.counter
+                self.counter += 1
+            return self.frames[index % len(self.frames)]
+
+
+def parse_range(header, size):
+    """Returns the (start, end) byte range requested by a single range Range
+    header, None if the header should be ignored or raises ValueError if the
+    range can't be satisfied."""
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if first == '' and last == '':
+        return None
+    if first == '':
+        length = int(last)
+        if length == 0:
+            raise ValueError('empty suffix range')
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError('range not satisfiable')
+    return start, end
+
+
+def guess_content_type(name):
+    return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+
+def make_generated_images(width, height):
+    """Returns the blank image and a list of noise frames or None if Pillow
+    isn't available."""
+    try:
+        from PIL import Image
+    except ImportError:
+        logging.warning('Pillow not installed. /blank.jpg and /noise.jpg are disabled.')
+        return None, []
+
+    def encode(image):
+        buf = io.BytesIO()
+        image.save(buf, format='JPEG')
+        return buf.getvalue()
+
+    blank = encode(Image.new('RGB', (width, height)))
+    noise = [encode(Image.frombytes('RGB', (width, height), os.urandom(width * height * 3))) for _ in range(NOISE_FRAMES)]
+    return blank, noise
+
+
+class PlaybackHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'playback'
+
+    def do_GET(self):
+        self.handle_request(send_body=True)
+
+    def do_HEAD(self):
+        self.handle_request(send_body=False)
+
+    def handle_request(self, send_body):
+        server = self.server
+        path = unquote(urlparse(self.path).path)
+
+        if path == '/blank.jpg' and server.blank is not None:
+            return self.send_bytes(server.blank, guess_content_type(path), send_body)
+
+        if path == '/noise.jpg' and server.noise:
+            return self.send_bytes(random.choice(server.noise), guess_content_type(path), send_body)
+
+        file_path = server.resolve(path)
+        if file_path is None:
+            return self.send_error(HTTPStatus.NOT_FOUND)
+
+        # image.jpg is served from the camera's image sequence unless an
+        # actual file with that name exists.
+        if file_path.name == 'image.jpg' and not file_path.is_file():
+            frame = server.get_sequence(file_path.parent / 'images').next_frame()
+            if frame is None:
+                return self.send_error(HTTPStatus.NOT_FOUND)
+            try:
+                data, _ = server.cache.get(frame)
+            except OSError:
+                # removed since the last scan
+                return self.send_error(HTTPStatus.NOT_FOUND)
+            # sequences can mix formats, so the type comes from the frame
+            return self.send_bytes(data, guess_content_type(frame.name), send_body)
+
+        if not file_path.is_file():
+            return self.send_error(HTTPStatus.NOT_FOUND)
+
+        self.send_file(file_path, send_body)
+
+    def send_bytes(self, data, content_type, send_body):
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        if send_body:
+            self.wfile.write(data)
+
+    def send_file(self, path, send_body):
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            mtime = os.fstat(f.fileno()).st_mtime
+
+            try:
+                byte_range = parse_range(self.headers.get('Range', ''), size) if 'Range' in self.headers else None
+            except ValueError:
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            if byte_range is None:
+                start, end = 0, size - 1
+                self.send_response(HTTPStatus.OK)
+            else:
+                start, end = byte_range
+                self.send_response(HTTPStatus.PARTIAL_CONTENT)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+
+            count = end - start + 1 if size > 0 else 0
+
+            self.send_header('Content-Type', guess_content_type(path.name))
+            self.send_header('Content-Length', str(count))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Last-Modified', email.utils.formatdate(mtime, usegmt=True))
+            self.end_headers()
+
+            if send_body and count > 0:
+                # wfile is unbuffered, so the headers are already written and
+                # the body can go directly from the file to the socket.
+                self.wfile.flush()
+                self.connection.sendfile(f, start, count)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class PlaybackServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, root, fps, cache_bytes, blank, noise, verbose=False):
+        super().__init__(address, PlaybackHandler)
+        self.root = Path(root).resolve()
+        self.fps = fps
+        self.cache = FrameCache(cache_bytes)
+        self.blank = blank
+        self.noise = noise
+        self.verbose = verbose
+        self.sequences = {}
+        self.sequences_lock = threading.Lock()
+
+    def resolve(self, path):
+        """Returns the path inside root for a request path or None if it
+        would escape root."""
+        file_path = (self.root / path.lstrip('/')).resolve()
+        if file_path != self.root and self.root not in file_path.parents:
+            return None
+        return file_path
+
+    def get_sequence(self, dir):
+        with self.sequences_lock:
+            sequence = self.sequences.get(dir)
+            if sequence is None:
+                sequence = ImageSequence(dir, self.fps)
+                self.sequences[dir] = sequence
+            return sequence
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', default=os.environ.get('PLAYBACK_ROOT', '/data'), help='data directory to serve')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PLAYBACK_PORT', '8090')), help='port to listen on')
+    parser.add_argument('--fps', type=float, default=float(os.environ.get('PLAYBACK_FPS', '0')), help='image sequence frame rate. 0 advances one frame per request.')
+    parser.add_argument('--cache-bytes', type=int, default=int(os.environ.get('PLAYBACK_CACHE_BYTES', str(64 * 1024 * 1024))), help='max size of frame cache')
+    parser.add_argument('--generated-size', default='800x600', help='size of blank and noise images')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log requests')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    width, height = map(int, args.generated_size.split('x'))
+    blank, noise = make_generated_images(width, height)
+
+    server = PlaybackServer(('', args.port), args.root, args.fps, args.cache_bytes, blank, noise, args.verbose)
+    logging.info('serving %s on port %d', args.root, args.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
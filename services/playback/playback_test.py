@@ -0,0 +1,51 @@
+import http.client
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+from playback import PlaybackServer
+
+
+class TestPlayback(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        images = Path(self.dir.name, 'bottom', 'images')
+        images.mkdir(parents=True)
+        (images / 'a.png').write_bytes(b'png frame')
+        (images / 'b.jpg').write_bytes(b'jpeg frame')
+
+        self.server = PlaybackServer(('127.0.0.1', 0), self.dir.name, fps=0, cache_bytes=1 << 20,
+                                     blank=b'blank', noise=[b'noise'])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.conn = http.client.HTTPConnection(*self.server.server_address)
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.dir.cleanup()
+
+    def get(self, path):
+        self.conn.request('GET', path)
+        resp = self.conn.getresponse()
+        return resp.status, resp.getheader('Content-Type'), resp.read()
+
+    def test_sequence_content_type(self):
+        # each frame is sent with its own type, not the type of image.jpg
+        self.assertEqual(self.get('/bottom/image.jpg'), (200, 'image/png', b'png frame'))
+        self.assertEqual(self.get('/bottom/image.jpg'), (200, 'image/jpeg', b'jpeg frame'))
+        self.assertEqual(self.get('/bottom/image.jpg'), (200, 'image/png', b'png frame'))
+
+    def test_generated_content_type(self):
+        self.assertEqual(self.get('/blank.jpg'), (200, 'image/jpeg', b'blank'))
+        self.assertEqual(self.get('/noise.jpg'), (200, 'image/jpeg', b'noise'))
+
+    def test_file_content_type(self):
+        self.assertEqual(self.get('/bottom/images/a.png'), (200, 'image/png', b'png frame'))
+        self.assertEqual(self.get('/missing.png')[0], 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
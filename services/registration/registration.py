@@ -1,5 +1,12 @@
+import collections
+import concurrent.futures
+import contextlib
+from cryptography import x509
+from cryptography.hazmat.primitives import serialization
+import random
 import subprocess
 import re
+import tempfile
 from pathlib import Path
 import requests
 import time
@@ -16,6 +23,17 @@ logging.basicConfig(
 WAGGLE_NODE_ID = os.environ['WAGGLE_NODE_ID']
 WAGGLE_BEEHIVE_HOST = os.environ['WAGGLE_BEEHIVE_HOST']
 
+# fraction of certificate lifetime before expiry in which to renew
+RENEW_WINDOW_FRACTION = float(os.environ.get('WAGGLE_RENEW_WINDOW_FRACTION', '0.1'))
+MIN_RENEW_WINDOW = 3600
+MIN_RENEW_INTERVAL = 3600
+
+# cap on how long to sleep, so externally removed credentials are noticed
+MAX_SLEEP = 86400
+
+BACKOFF_BASE = 10
+BACKOFF_MAX = 3600
+
 
 def scan_block(s, head, tail):
     match = re.search(head, s)
@@ -58,28 +76,20 @@ should_exist = [
 ]
 
 
-def get_cacert_from_local_cert_server():
-    r = requests.get(f'http://{WAGGLE_BEEHIVE_HOST}:24181/certca')
-    r.raise_for_status()
-    return scan_certificate(r.text)
-
-
-def get_credentials_from_local_cert_server():
-    r = requests.get(
-        f'http://{WAGGLE_BEEHIVE_HOST}:24181/node?{WAGGLE_NODE_ID}')
-    r.raise_for_status()
-    return r.text
-
+@contextlib.contextmanager
+def timed(phase):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        logging.info('%s took %.3fs', phase, time.monotonic() - start)
 
-def register_with_local_cert_server():
-    cacert = get_cacert_from_local_cert_server()
-    logging.info('got ca cert')
 
-    response = get_credentials_from_local_cert_server()
-    cert = scan_certificate(response)
-    key = scan_key(response)
-    port = scan_port(response)
-    logging.info('got credentials')
+def save_credentials(cacert_response, credentials_response):
+    cacert = scan_certificate(cacert_response)
+    cert = scan_certificate(credentials_response)
+    key = scan_key(credentials_response)
+    port = scan_port(credentials_response)
 
     Path('/etc/waggle/cacert.pem').write_text(cacert)
     Path('/etc/waggle/cert.pem').write_text(cert)
@@ -87,78 +97,218 @@ def register_with_local_cert_server():
     Path('/etc/waggle/reverse_ssh_port').write_text(port)
 
 
-def get_cacert_from_ssh_cert_server():
-    output = subprocess.check_output([
-        'ssh',
-        '-i', '/etc/waggle/register.pem',
-        '-o', 'StrictHostKeyChecking=no',
-        '-p', '20022',
-        f'root@{WAGGLE_BEEHIVE_HOST}',
-        'certca'
-    ]).decode()
+def fetch_from_local_cert_server():
+    # fetch the ca cert and node credentials in parallel over a single
+    # pooled session.
+    with requests.Session() as session, concurrent.futures.ThreadPoolExecutor(2) as executor:
+        def get(path):
+            with timed(f'get {path}'):
+                r = session.get(f'http://{WAGGLE_BEEHIVE_HOST}:24181/{path}')
+                r.raise_for_status()
+                return r.text
 
-    return scan_certificate(output)
+        return tuple(executor.map(get, ['certca', f'node?{WAGGLE_NODE_ID}']))
 
 
-def get_credentials_from_ssh_cert_server():
-    output = subprocess.check_output([
+def register_with_local_cert_server():
+    with timed('fetching credentials from local cert server'):
+        cacert_response, credentials_response = fetch_from_local_cert_server()
+    logging.info('got ca cert and credentials')
+
+    with timed('saving credentials'):
+        save_credentials(cacert_response, credentials_response)
+
+
+def ssh_command(control_path, *options, command=None):
+    return [
         'ssh',
         '-i', '/etc/waggle/register.pem',
         '-o', 'StrictHostKeyChecking=no',
+        '-o', f'ControlPath={control_path}',
         '-p', '20022',
+        *options,
         f'root@{WAGGLE_BEEHIVE_HOST}',
-        f'node?{WAGGLE_NODE_ID}',
-    ]).decode()
+        *([command] if command is not None else []),
+    ]
 
-    return output
 
+def fetch_from_ssh_cert_server():
+    # open a single master connection and run both commands over it, so we
+    # only pay for one ssh handshake.
+    with tempfile.TemporaryDirectory() as tmpdir:
+        control_path = os.path.join(tmpdir, 'control.sock')
 
-def register_with_ssh_cert_server():
-    cacert = get_cacert_from_ssh_cert_server()
-    logging.info('got ca cert')
+        with timed('ssh connect'):
+            subprocess.check_call(ssh_command(
+                control_path, '-o', 'ControlMaster=yes', '-o', 'ControlPersist=yes', '-f', '-N'))
 
-    response = get_credentials_from_ssh_cert_server()
-    cert = scan_certificate(response)
-    key = scan_key(response)
-    port = scan_port(response)
-    logging.info('got credentials')
+        def run(command):
+            with timed(f'ssh {command}'):
+                return subprocess.check_output(ssh_command(control_path, command=command)).decode()
 
-    Path('/etc/waggle/cacert.pem').write_text(cacert)
-    Path('/etc/waggle/cert.pem').write_text(cert)
-    Path('/etc/waggle/key.pem').write_text(key)
-    Path('/etc/waggle/reverse_ssh_port').write_text(port)
+        commands = ['certca', f'node?{WAGGLE_NODE_ID}']
 
+        try:
+            try:
+                with concurrent.futures.ThreadPoolExecutor(len(commands)) as executor:
+                    return tuple(executor.map(run, commands))
+            except subprocess.CalledProcessError:
+                # some servers limit the number of sessions per connection
+                logging.warning('parallel ssh commands failed. retrying one at a time.')
+                return tuple(map(run, commands))
+        finally:
+            subprocess.run(ssh_command(control_path, '-O', 'exit'),
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
-def register_if_needed():
-    logging.info('checking for credentials')
 
-    # TODO check if credentials are valid
-    if all(path.exists() for path in should_exist):
-        logging.info('already has credentials - will not reregister')
-        return
+def register_with_ssh_cert_server():
+    with timed('fetching credentials from ssh cert server'):
+        cacert_response, credentials_response = fetch_from_ssh_cert_server()
+    logging.info('got ca cert and credentials')
+
+    with timed('saving credentials'):
+        save_credentials(cacert_response, credentials_response)
 
+
+def register():
     logging.info('starting registration of node %s on beehive %s.',
                  WAGGLE_NODE_ID, WAGGLE_BEEHIVE_HOST)
 
     # TODO add support for using registration key
 
-    if Path('/etc/waggle/register.pem').exists():
-        logging.info('registration key exists. registering over ssh.')
-        register_with_ssh_cert_server()
-    else:
-        logging.warning(
-            'registration key does not exist. falling back to local cert server.')
-        register_with_local_cert_server()
+    with timed('registration'):
+        if Path('/etc/waggle/register.pem').exists():
+            logging.info('registration key exists. registering over ssh.')
+            register_with_ssh_cert_server()
+        else:
+            logging.warning(
+                'registration key does not exist. falling back to local cert server.')
+            register_with_local_cert_server()
 
     logging.info('finished registration of node %s on %s.',
                  WAGGLE_NODE_ID, WAGGLE_BEEHIVE_HOST)
 
 
+CredentialsInfo = collections.namedtuple('CredentialsInfo', ['not_after', 'renew_at', 'key_matches'])
+
+
+def load_credentials_info():
+    cert = x509.load_pem_x509_certificate(Path('/etc/waggle/cert.pem').read_bytes())
+    key = serialization.load_pem_private_key(Path('/etc/waggle/key.pem').read_bytes(), password=None)
+
+    not_before = cert.not_valid_before_utc.timestamp()
+    not_after = cert.not_valid_after_utc.timestamp()
+
+    # renew at a random point in the last part of the certificate's lifetime,
+    # so a fleet of nodes registered together don't all renew together.
+    window = max((not_after - not_before) * RENEW_WINDOW_FRACTION, MIN_RENEW_WINDOW)
+    renew_at = not_after - window + random.uniform(0, window / 2)
+
+    key_matches = cert.public_key().public_numbers() == key.public_key().public_numbers()
+
+    return CredentialsInfo(not_after, renew_at, key_matches)
+
+
+def backoff_delay(failures):
+    # exponential backoff with jitter, so nodes retrying against a failed
+    # cert server don't all retry together.
+    delay = min(BACKOFF_BASE * 2 ** (failures - 1), BACKOFF_MAX)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class RenewalScheduler:
+    """RenewalScheduler registers the node when credentials are missing,
+    invalid or due for renewal and otherwise sleeps until renewal is due.
+
+    The parsed credentials are cached until cert.pem or key.pem change.
+    """
+
+    def __init__(self):
+        self.failures = 0
+        self.cached_stat = None
+        self.cached_info = None
+        self.last_registered = None
+        self.just_registered = False
+
+    def get_credentials_info(self):
+        if not all(path.exists() for path in should_exist):
+            return None
+
+        stat = tuple((p.stat().st_mtime_ns, p.stat().st_size) for p in should_exist)
+
+        if stat != self.cached_stat:
+            self.cached_stat = stat
+            try:
+                self.cached_info = load_credentials_info()
+            except Exception:
+                logging.exception('failed to load credentials')
+                self.cached_info = None
+
+        return self.cached_info
+
+    def registration_reason(self, info, now):
+        if info is None:
+            return 'credentials are missing or invalid'
+        if not info.key_matches:
+            return 'key does not match certificate'
+        if now >= info.not_after:
+            return 'certificate has expired'
+        if now >= info.renew_at:
+            return 'certificate is due for renewal'
+        return None
+
+    def run_once(self):
+        """Registers if needed and returns the number of seconds to wait
+        before the next check."""
+        logging.info('checking for credentials')
+
+        info = self.get_credentials_info()
+        now = time.time()
+        reason = self.registration_reason(info, now)
+
+        if reason is None:
+            self.failures = 0
+            self.just_registered = False
+            logging.info('credentials are valid until %s. renewing at %s.',
+                         time.ctime(info.not_after), time.ctime(info.renew_at))
+            return min(info.renew_at - now, MAX_SLEEP)
+
+        # avoid renewing over and over if the server keeps giving us
+        # certificates which are already due for renewal.
+        if (info is not None and info.key_matches and now < info.not_after and
+                self.last_registered is not None and now - self.last_registered < MIN_RENEW_INTERVAL):
+            self.just_registered = False
+            return MIN_RENEW_INTERVAL - (now - self.last_registered)
+
+        # registering succeeded but didn't leave us with usable credentials,
+        # so back off instead of registering again right away.
+        if self.just_registered:
+            self.just_registered = False
+            self.failures += 1
+            delay = backoff_delay(self.failures)
+            logging.warning('credentials still invalid after registering: %s. retrying in %.0fs.', reason, delay)
+            return delay
+
+        logging.info('registering: %s', reason)
+
+        try:
+            register()
+        except Exception:
+            self.failures += 1
+            delay = backoff_delay(self.failures)
+            logging.exception('registration failed. retrying in %.0fs.', delay)
+            return delay
+
+        self.last_registered = time.time()
+        self.just_registered = True
+        return 0
+
+
 def main():
     logging.info('starting registration service')
+    scheduler = RenewalScheduler()
     while True:
-        register_if_needed()
-        time.sleep(300)
+        time.sleep(scheduler.run_once())
 
 
 if __name__ == '__main__':
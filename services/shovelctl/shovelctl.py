@@ -1,9 +1,13 @@
 import argparse
 import requests
+import requests.adapters
 import json
 import re
 import os
+import sys
 import time
+from datetime import datetime, timezone
+from pathlib import Path
 
 WAGGLE_NODE_ID = os.environ['WAGGLE_NODE_ID'].lower()
 WAGGLE_SUB_ID = os.environ['WAGGLE_SUB_ID'].lower()
@@ -27,6 +31,33 @@ beehive_uri = (
     # '&heartbeat=60'
 )
 
+# shovel profiles tune how shovels trade latency for throughput. these can be
+# overridden and extended using the profiles file.
+default_profiles = {
+    # matches the settings used before profiles were added
+    'default': {
+        'reconnect-delay': 60,
+    },
+    'low-latency': {
+        'prefetch-count': 10,
+        'ack-mode': 'on-confirm',
+        'delete-after': 'never',
+        'reconnect-delay': 5,
+    },
+    'high-throughput': {
+        'prefetch-count': 1000,
+        'ack-mode': 'on-confirm',
+        'delete-after': 'never',
+        'reconnect-delay': 5,
+    },
+    'constrained-link': {
+        'prefetch-count': 100,
+        'ack-mode': 'on-confirm',
+        'delete-after': 'never',
+        'reconnect-delay': 30,
+    },
+}
+
 configs = {
     'push-to-beehive-v1': {
         'src-uri': node_uri,
@@ -39,7 +70,6 @@ configs = {
             # old data path uses short node ID
             'reply_to': WAGGLE_NODE_ID[-12:],
         },
-        'reconnect-delay': 60,
     },
     'push-to-beehive-v2': {
         'src-uri': node_uri,
@@ -50,7 +80,6 @@ configs = {
             'delivery_mode': 2,
             'user_id': beehive_username,
         },
-        'reconnect-delay': 60,
     },
     'pull-from-beehive-v2': {
         'src-uri': beehive_uri,
@@ -60,39 +89,128 @@ configs = {
         'publish-properties': {
             'delivery_mode': 2,
         },
-        'reconnect-delay': 60,
     },
 }
 
+
+def load_profiles(path):
+    """Loads the profiles file, if it exists. The file looks like:
+
+    {
+        "default-profile": "high-throughput",
+        "profiles": {
+            "high-throughput": {"prefetch-count": 2000}
+        },
+        "shovels": {
+            "push-to-beehive-v2": "constrained-link"
+        },
+        "connections": {
+            "push-to-beehive-v2": 4
+        }
+    }
+
+    Profiles in the file are merged into the built-in ones with the same name.
+    Returns the merged profiles and the rest of the file.
+    """
+    profiles = {name: dict(profile) for name, profile in default_profiles.items()}
+
+    try:
+        data = json.loads(Path(path).read_text())
+    except FileNotFoundError:
+        return profiles, {}
+
+    for name, profile in data.get('profiles', {}).items():
+        profiles.setdefault(name, {}).update(profile)
+
+    return profiles, data
+
+
+def get_connection_names(name, connections):
+    """Returns the names of the parallel shovels for a path. The first keeps the
+    original name, so a single connection is set up the same way as before."""
+    return [name] + [f'{name}-{i}' for i in range(1, connections)]
+
+
+def get_shovel_configs(profiles_path, profile_override=None, connections_override=None):
+    profiles, data = load_profiles(profiles_path)
+    shovel_profiles = data.get('shovels', {})
+    default_profile = data.get('default-profile', 'default')
+    connections = dict(data.get('connections', {}))
+
+    if connections_override is not None:
+        connections['push-to-beehive-v2'] = connections_override
+
+    results = {}
+
+    for name, config in configs.items():
+        profile_name = profile_override or shovel_profiles.get(name, default_profile)
+
+        try:
+            profile = profiles[profile_name]
+        except KeyError:
+            raise SystemExit(f'unknown shovel profile {profile_name!r}. available profiles: {", ".join(profiles)}')
+
+        count = int(connections.get(name, 1))
+
+        if count < 1:
+            raise SystemExit(f'shovel {name} must have at least one connection')
+
+        # each shovel opens its own connection and competes for messages on
+        # the same source queue.
+        for shovel_name in get_connection_names(name, count):
+            results[shovel_name] = {**config, **profile}
+
+    return results
+
+
+def is_managed_shovel(name):
+    return any(re.fullmatch(re.escape(base) + r'(-\d+)?', name) for base in configs)
+
+
 auth = ('admin', 'admin')
 
 
-def wait_for_rabbitmq():
+def wait_for_rabbitmq(file=sys.stdout):
     while True:
-        print('waiting for rabbitmq...', flush=True)
+        print('waiting for rabbitmq...', file=file, flush=True)
         try:
             return requests.get(f'http://rabbitmq:15672/api/')
         except requests.exceptions.ConnectionError:
             time.sleep(5)
 
 
-def enable_shovels():
+def get_existing_shovels(session):
+    r = session.get('http://rabbitmq:15672/api/parameters/shovel/%2f')
+    r.raise_for_status()
+    return [p['name'] for p in r.json()]
+
+
+def enable_shovels(args):
     print(
         f'enabling shovels for {WAGGLE_NODE_ID}:{WAGGLE_SUB_ID} on {WAGGLE_BEEHIVE_HOST}.', flush=True)
 
+    shovel_configs = get_shovel_configs(args.profiles, args.profile, args.connections)
+
     wait_for_rabbitmq()
 
     with requests.Session() as session:
         session.auth = auth
 
-        for name, config in configs.items():
+        for name, config in shovel_configs.items():
             r = session.put(f'http://rabbitmq:15672/api/parameters/shovel/%2f/{name}', json={
                 'value': config,
             })
             print(f'enabled shovel {name}')
 
+        # remove extra parallel shovels left over from a larger connection count
+        for name in get_existing_shovels(session):
+            if is_managed_shovel(name) and name not in shovel_configs:
+                r = session.delete(
+                    f'http://rabbitmq:15672/api/parameters/shovel/%2f/{name}')
+                print(f'disabled shovel {name}')
+
 
-def disable_shovels():
+def disable_shovels(args):
     print(
         f'disabling shovels for {WAGGLE_NODE_ID}:{WAGGLE_SUB_ID} on {WAGGLE_BEEHIVE_HOST}.', flush=True)
 
@@ -101,18 +219,171 @@ def disable_shovels():
     with requests.Session() as session:
         session.auth = auth
 
-        for name in configs.keys():
+        # includes any parallel shovels, even if the connection count changed
+        # since they were enabled
+        for name in get_existing_shovels(session):
+            if not is_managed_shovel(name):
+                continue
             r = session.delete(
                 f'http://rabbitmq:15672/api/parameters/shovel/%2f/{name}')
             print(f'disabled shovel {name}')
 
 
+queue_columns = ','.join([
+    'name',
+    'messages',
+    'consumers',
+    'message_stats.publish',
+    'message_stats.ack',
+    'message_stats.deliver_no_ack',
+])
+
+
+def get_queue_stats(queue):
+    stats = queue.get('message_stats', {})
+    return {
+        'messages': queue.get('messages', 0),
+        'consumers': queue.get('consumers', 0),
+        'published': stats.get('publish', 0),
+        'delivered': stats.get('ack', 0) + stats.get('deliver_no_ack', 0),
+    }
+
+
+def get_shovel_states(session):
+    # /api/shovels requires the shovel management plugin, so we fall back to
+    # reporting parameters only when it isn't available.
+    r = session.get('http://rabbitmq:15672/api/shovels/%2f')
+    if r.status_code == 404:
+        return {}
+    r.raise_for_status()
+    return {s['name']: s.get('state', 'unknown') for s in r.json()}
+
+
+def take_sample(session):
+    r = session.get('http://rabbitmq:15672/api/queues/%2f', params={'columns': queue_columns})
+    r.raise_for_status()
+    queues = {q['name']: get_queue_stats(q) for q in r.json()}
+
+    r = session.get('http://rabbitmq:15672/api/parameters/shovel/%2f')
+    r.raise_for_status()
+    shovels = {p['name']: p['value'] for p in r.json()}
+
+    return time.monotonic(), queues, shovels, get_shovel_states(session)
+
+
+def compute_rates(prev, curr):
+    prev_time, prev_queues, _, _ = prev
+    curr_time, curr_queues, shovels, states = curr
+    dt = curr_time - prev_time
+
+    queues = {}
+
+    for name, stats in curr_queues.items():
+        before = prev_queues.get(name, stats)
+        in_rate = max(stats['published'] - before['published'], 0) / dt
+        out_rate = max(stats['delivered'] - before['delivered'], 0) / dt
+        growth = (stats['messages'] - before['messages']) / dt
+
+        # estimate drain time from how fast the backlog is actually shrinking
+        if stats['messages'] == 0:
+            drain_time = 0
+        elif growth < 0:
+            drain_time = stats['messages'] / -growth
+        else:
+            drain_time = None
+
+        queues[name] = {
+            'messages': stats['messages'],
+            'consumers': stats['consumers'],
+            'in_rate': in_rate,
+            'out_rate': out_rate,
+            'growth': growth,
+            'drain_time': drain_time,
+        }
+
+    results = {}
+
+    # shovels competing on the same source queue share its delivery rate
+    for name, value in shovels.items():
+        src_queue = value.get('src-queue')
+        src_shovels = sum(1 for v in shovels.values() if v.get('src-queue') == src_queue)
+        queue = queues.get(src_queue, {})
+        results[name] = {
+            'state': states.get(name, 'unknown'),
+            'src_queue': src_queue,
+            'dest': value.get('dest-queue') or value.get('dest-exchange'),
+            'rate': queue.get('out_rate', 0) / src_shovels,
+        }
+
+    return {
+        'time': datetime.now(timezone.utc).isoformat(),
+        'interval': dt,
+        'shovels': results,
+        'queues': queues,
+    }
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return 'never'
+    if seconds < 60:
+        return f'{seconds:.0f}s'
+    if seconds < 3600:
+        return f'{seconds/60:.1f}m'
+    return f'{seconds/3600:.1f}h'
+
+
+def print_status(status):
+    print(f'=== {status["time"]} ===')
+    print()
+    print(f'{"shovel":<24} {"state":<12} {"source":<24} {"msg/s":>10}')
+    for name, s in sorted(status['shovels'].items()):
+        print(f'{name:<24} {s["state"]:<12} {s["src_queue"] or "":<24} {s["rate"]:>10.1f}')
+    print()
+    print(f'{"queue":<24} {"messages":>10} {"in/s":>10} {"out/s":>10} {"growth/s":>10} {"drain":>8}')
+    for name, q in sorted(status['queues'].items()):
+        print(f'{name:<24} {q["messages"]:>10} {q["in_rate"]:>10.1f} {q["out_rate"]:>10.1f} {q["growth"]:>+10.1f} {format_duration(q["drain_time"]):>8}')
+    print(flush=True)
+
+
+def show_status(args):
+    wait_for_rabbitmq(file=sys.stderr)
+
+    with requests.Session() as session:
+        session.auth = auth
+        # all polls reuse a single keep-alive connection to the management api
+        session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1))
+
+        prev = take_sample(session)
+
+        while True:
+            time.sleep(args.interval)
+            curr = take_sample(session)
+            status = compute_rates(prev, curr)
+            prev = curr
+
+            if args.json:
+                print(json.dumps(status, separators=(',', ':')), flush=True)
+            else:
+                print_status(status)
+
+            if not args.watch:
+                break
+
+
 actions = {
     'enable': enable_shovels,
     'disable': disable_shovels,
+    'status': show_status,
 }
 
 parser = argparse.ArgumentParser()
 parser.add_argument('action', choices=actions.keys())
+parser.add_argument('--profiles', default=os.environ.get('WAGGLE_SHOVEL_PROFILES', '/etc/waggle/shovel-profiles.json'), help='path to shovel profiles file')
+parser.add_argument('--profile', default=os.environ.get('WAGGLE_SHOVEL_PROFILE') or None, help='use this profile for all shovels')
+parser.add_argument('--connections', type=int, default=os.environ.get('WAGGLE_PUSH_CONNECTIONS') or None, help='number of parallel push-to-beehive-v2 shovels')
+parser.add_argument('--watch', action='store_true', help='keep showing status')
+parser.add_argument('--interval', type=float, default=5.0, help='status polling interval in seconds')
+parser.add_argument('--json', action='store_true', help='write status as json lines')
 args = parser.parse_args()
-actions[args.action]()
+actions[args.action](args)
@@ -0,0 +1,171 @@
+"""
+On-disk spool of messages stored as a sequence of gzip segments.
+
+Each record is a big endian 2 byte routing key length, 4 byte body length,
+the routing key and the body. A segment is written as <seq>.open and renamed
+to <seq>.seg once it's closed, so readers only ever see complete segments.
+Writes are sync flushed, so a segment which wasn't closed cleanly can still
+be read up to its last flush.
+
+Drain progress within the oldest segment is kept in progress.json, so a
+restart doesn't resend records which were already confirmed.
+"""
+import gzip
+import json
+import logging
+import os
+import struct
+import time
+import zlib
+from pathlib import Path
+
+
+HEADER = struct.Struct('>HI')
+
+
+def write_record(file, routing_key, body):
+    key = routing_key.encode()
+    file.write(HEADER.pack(len(key), len(body)))
+    file.write(key)
+    file.write(body)
+
+
+def read_segment(path):
+    """Yields (routing key, body) for each record in a segment. Reading stops
+    quietly at a truncated or corrupt tail."""
+    with gzip.open(path, 'rb') as file:
+        while True:
+            try:
+                header = file.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    return
+                key_size, body_size = HEADER.unpack(header)
+                data = file.read(key_size + body_size)
+            except (EOFError, OSError, zlib.error):
+                logging.warning('Segment %s is truncated.', path.name)
+                return
+            if len(data) < key_size + body_size:
+                logging.warning('Segment %s is truncated.', path.name)
+                return
+            yield data[:key_size].decode(), data[key_size:]
+
+
+class Spool:
+
+    def __init__(self, dir, segment_bytes, segment_age, max_bytes=0):
+        self.dir = Path(dir)
+        self.segment_bytes = segment_bytes
+        self.segment_age = segment_age
+        self.max_bytes = max_bytes
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.file = None
+        self.recover()
+
+    def recover(self):
+        # segments left open by a crash were flushed up to their last ack, so
+        # we close them as they are.
+        for path in self.dir.glob('*.open'):
+            logging.info('Recovering segment %s.', path.name)
+            path.rename(path.with_suffix('.seg'))
+
+    def segments(self):
+        """Returns the closed segments, oldest first."""
+        return sorted(self.dir.glob('*.seg'))
+
+    def size(self):
+        total = 0
+        for path in self.dir.glob('*.seg'):
+            try:
+                total += path.stat().st_size
+            except FileNotFoundError:
+                pass
+        return total
+
+    def next_seq(self):
+        seqs = [int(p.stem) for p in self.dir.iterdir() if p.suffix in ('.seg', '.open') and p.stem.isdigit()]
+        return max(seqs, default=0) + 1
+
+    def open(self):
+        self.enforce_max_bytes()
+        self.path = self.dir / f'{self.next_seq():012d}.open'
+        self.raw = open(self.path, 'wb')
+        self.file = gzip.GzipFile(fileobj=self.raw, mode='wb')
+        self.opened_at = time.monotonic()
+        self.records = 0
+
+    def append(self, routing_key, body):
+        if self.file is None:
+            self.open()
+        write_record(self.file, routing_key, body)
+        self.records += 1
+
+    def flush(self):
+        """Makes everything appended so far durable. Returns once it's safe
+        to ack the appended messages."""
+        if self.file is None:
+            return
+        self.file.flush(zlib.Z_SYNC_FLUSH)
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+
+        if self.raw.tell() >= self.segment_bytes or time.monotonic() - self.opened_at >= self.segment_age:
+            self.close()
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.close()
+        os.fsync(self.raw.fileno())
+        self.raw.close()
+        self.file = None
+        if self.records > 0:
+            self.path.rename(self.path.with_suffix('.seg'))
+        else:
+            self.path.unlink()
+
+    def enforce_max_bytes(self):
+        """Drops the oldest segments until the spool is under max_bytes. This
+        loses the messages in them, so it's only done when max_bytes is set."""
+        if self.max_bytes <= 0:
+            return
+        size = self.size()
+        for path in self.segments():
+            if size < self.max_bytes:
+                break
+            progress = self.load_progress()
+            done = progress.get('records', 0) if progress.get('segment') == path.name else 0
+            try:
+                dropped = path.stat().st_size
+                lost = sum(1 for _ in read_segment(path)) - done
+                path.unlink()
+            except FileNotFoundError:
+                continue
+            if done > 0:
+                self.clear_progress()
+            size -= dropped
+            logging.warning('Spool is over %d bytes. Dropped oldest segment %s and lost %d messages.',
+                            self.max_bytes, path.name, lost)
+
+    def load_progress(self):
+        try:
+            return json.loads((self.dir / 'progress.json').read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save_progress(self, segment, records):
+        tmp = self.dir / 'progress.json.tmp'
+        tmp.write_text(json.dumps({'segment': segment.name, 'records': records}))
+        os.replace(tmp, self.dir / 'progress.json')
+
+    def clear_progress(self):
+        try:
+            (self.dir / 'progress.json').unlink()
+        except FileNotFoundError:
+            pass
+
+    def remove(self, segment):
+        try:
+            segment.unlink()
+        except FileNotFoundError:
+            pass
+        self.clear_progress()
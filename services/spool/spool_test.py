@@ -0,0 +1,205 @@
+import gzip
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from segments import Spool, read_segment
+
+os.environ.setdefault('WAGGLE_NODE_ID', '0000000000000001')
+os.environ.setdefault('WAGGLE_BEEHIVE_HOST', 'beehive')
+
+try:
+    import spool
+    import waggle.protocol
+except ImportError:
+    spool = None
+
+
+def make_record(sender_sub_id, bodies, timestamp=1600000000):
+    return waggle.protocol.pack_waggle_packets([{
+        'sender_id': '0000000000000001',
+        'sender_sub_id': sender_sub_id,
+        'timestamp': timestamp,
+        'body': waggle.protocol.pack_datagrams([{'body': body} for body in bodies]),
+    }])
+
+
+class TestSegments(unittest.TestCase):
+
+    def test_read_segment(self):
+        with tempfile.TemporaryDirectory() as dir:
+            s = Spool(dir, segment_bytes=1 << 20, segment_age=60)
+            for i in range(10):
+                s.append('a.b', f'message {i}'.encode())
+            s.close()
+
+            segments = s.segments()
+            self.assertEqual(len(segments), 1)
+            self.assertEqual(list(read_segment(segments[0])),
+                             [('a.b', f'message {i}'.encode()) for i in range(10)])
+
+    def test_read_truncated_segment(self):
+        with tempfile.TemporaryDirectory() as dir:
+            s = Spool(dir, segment_bytes=1 << 20, segment_age=60)
+            for i in range(5):
+                s.append('a.b', f'message {i}'.encode())
+            s.flush()
+            flushed = s.path.stat().st_size
+            for i in range(5, 10):
+                s.append('a.b', f'message {i}'.encode() * 100)
+            s.file.flush()
+
+            # simulate a crash partway through writing after the flush
+            path = s.path
+            with open(path, 'r+b') as file:
+                file.truncate(flushed + 10)
+
+            with self.assertLogs(level='WARNING'):
+                records = list(read_segment(path))
+
+            self.assertEqual(records[:5], [('a.b', f'message {i}'.encode()) for i in range(5)])
+            self.assertTrue(all(body.startswith(b'message') for _, body in records))
+
+    def test_read_corrupt_segment(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = Path(dir, '000000000001.seg')
+            path.write_bytes(gzip.compress(b'\x00\x03\x00\x00\x00\x05a.bhello') + b'garbage')
+
+            with self.assertLogs(level='WARNING'):
+                records = list(read_segment(path))
+
+            self.assertEqual(records, [('a.b', b'hello')])
+
+    def test_recover(self):
+        with tempfile.TemporaryDirectory() as dir:
+            s = Spool(dir, segment_bytes=1 << 20, segment_age=60)
+            s.append('a.b', b'hello')
+            s.flush()
+            # leave the segment open as if the process had been killed
+            s.raw.close()
+
+            recovered = Spool(dir, segment_bytes=1 << 20, segment_age=60)
+            segments = recovered.segments()
+            self.assertEqual([p.name for p in segments], ['000000000001.seg'])
+            self.assertEqual(list(read_segment(segments[0])), [('a.b', b'hello')])
+
+            # new segments must come after the recovered one
+            recovered.append('a.b', b'world')
+            recovered.close()
+            self.assertEqual([p.name for p in recovered.segments()], ['000000000001.seg', '000000000002.seg'])
+
+    def test_progress(self):
+        with tempfile.TemporaryDirectory() as dir:
+            s = Spool(dir, segment_bytes=1 << 20, segment_age=60)
+            s.append('a.b', b'hello')
+            s.close()
+            segment = s.segments()[0]
+
+            self.assertEqual(s.load_progress(), {})
+            s.save_progress(segment, 3)
+            self.assertEqual(Spool(dir, 1 << 20, 60).load_progress(), {'segment': segment.name, 'records': 3})
+
+            s.remove(segment)
+            self.assertEqual(s.segments(), [])
+            self.assertEqual(s.load_progress(), {})
+
+    def test_enforce_max_bytes(self):
+        with tempfile.TemporaryDirectory() as dir:
+            s = Spool(dir, segment_bytes=1 << 20, segment_age=60)
+            for i in range(3):
+                for _ in range(3):
+                    s.append('a.b', os.urandom(1000))
+                s.close()
+
+            segments = s.segments()
+            self.assertEqual(len(segments), 3)
+
+            # unlimited by default
+            s.open()
+            s.close()
+            self.assertEqual(s.segments(), segments)
+
+            # the oldest segment was partly drained, so only the rest is lost
+            s.save_progress(segments[0], 1)
+
+            # only the oldest segment needs to go to get back under max bytes
+            s.max_bytes = s.size() - 1
+            with self.assertLogs(level='WARNING') as logs:
+                s.open()
+            self.assertEqual(s.segments(), segments[1:])
+            self.assertIn('lost 2 messages', logs.output[0])
+            self.assertEqual(s.load_progress(), {})
+            s.close()
+
+
+@unittest.skipUnless(spool, 'requires pika and pywaggle')
+class TestSpool(unittest.TestCase):
+
+    def test_token_bucket(self):
+        with mock.patch('spool.time.monotonic', return_value=100.0) as monotonic:
+            bucket = spool.TokenBucket(rate=1000, burst=2000)
+            self.assertEqual(bucket.take(2000), 0)
+            self.assertAlmostEqual(bucket.take(500), 0.5)
+
+            monotonic.return_value = 101.0
+            self.assertAlmostEqual(bucket.take(500), 0)
+
+            # refills never exceed the burst
+            monotonic.return_value = 200.0
+            self.assertEqual(bucket.take(2000), 0)
+            self.assertAlmostEqual(bucket.take(1000), 1)
+
+        self.assertEqual(spool.TokenBucket(rate=0, burst=0).take(1 << 30), 0)
+
+    def test_batches(self):
+        records = [
+            ('a.b', make_record('0000000000000000', [b'1', b'2'])),
+            ('a.b', make_record('0000000000000000', [b'3'])),
+            ('c.d', make_record('0000000000000000', [b'4'])),
+            ('c.d', make_record('0000000000000002', [b'5'])),
+            ('c.d', b'not a packet'),
+            ('c.d', make_record('0000000000000002', [b'6'])),
+        ]
+
+        batches = list(spool.iter_batches(records, max_bytes=1 << 20))
+
+        self.assertEqual([(key, count) for key, _, count in batches],
+                         [('a.b', 2), ('c.d', 1), ('c.d', 1), ('c.d', 1), ('c.d', 1)])
+        self.assertEqual(batches[3][1], b'not a packet')
+
+        packets = waggle.protocol.unpack_waggle_packets(batches[0][1])
+        self.assertEqual(len(packets), 1)
+        self.assertEqual(packets[0]['sender_sub_id'], '0000000000000000')
+        datagrams = waggle.protocol.unpack_datagrams(packets[0]['body'])
+        self.assertEqual([d['body'] for d in datagrams], [b'1', b'2', b'3'])
+
+        packets = waggle.protocol.unpack_waggle_packets(batches[2][1])
+        self.assertEqual(packets[0]['sender_sub_id'], '0000000000000002')
+
+    def test_batches_keep_headers(self):
+        first = waggle.protocol.unpack_waggle_packets(make_record('0000000000000000', [b'1']))[0]
+        records = [
+            ('a.b', make_record('0000000000000000', [b'1'])),
+            ('a.b', make_record('0000000000000000', [b'2'], timestamp=1600000001)),
+        ]
+
+        batches = list(spool.iter_batches(records, max_bytes=1 << 20))
+        self.assertEqual([count for _, _, count in batches], [1, 1])
+
+        packet = waggle.protocol.unpack_waggle_packets(batches[0][1])[0]
+        self.assertEqual({k: v for k, v in packet.items() if k != 'body'},
+                         {k: v for k, v in first.items() if k != 'body'})
+
+    def test_batches_max_bytes(self):
+        records = [('a.b', make_record('0000000000000000', [bytes(100)])) for _ in range(10)]
+        size = len(waggle.protocol.unpack_waggle_packets(records[0][1])[0]['body'])
+
+        batches = list(spool.iter_batches(records, max_bytes=3 * size))
+        self.assertEqual([count for _, _, count in batches], [3, 3, 3, 1])
+        self.assertEqual(sum(count for _, _, count in batches), len(records))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+# ANL:waggle-license
+#  This file is part of the Waggle Platform.  Please see the file
+#  LICENSE.waggle.txt for the legal details of the copyright and software
+#  license.  For more details on the Waggle project, visit:
+#           http://www.wa8.gl
+# ANL:waggle-license
+"""
+Coalesces the datagrams of many staged messages into a single waggle packet.
+
+Staging has already stamped the plugin info into every datagram, so the
+datagrams of different plugins can share one packet without losing any per
+datagram metadata. Packet headers also carry a timestamp, sequence numbers
+and receiver, so only messages whose packet headers match exactly are
+coalesced and the coalesced packet reuses that header.
+"""
+import rewrite
+import waggle.protocol
+
+
+class Coalescer:
+    """Coalescer collects staged messages until either max_bytes of
+    datagrams or max_messages messages are buffered, or a message with a
+    different packet header or routing key arrives. Each flush returns a
+    (delivery tags, routing key, properties, body) batch, where delivery tags
+    are the source deliveries covered by the batch.
+
+    The caller is responsible for flushing on a timer. generation changes on
+    every flush, so a timer can check whether the batch it was started for is
+    still pending.
+    """
+
+    def __init__(self, max_bytes, max_messages, fast_path=True):
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.fast_path = fast_path
+        self.generation = 0
+        self.reset()
+
+    def reset(self):
+        self.delivery_tags = []
+        self.datagrams = []
+        self.size = 0
+        self.header = None
+        self.routing_key = None
+        self.properties = None
+
+    def __len__(self):
+        return len(self.delivery_tags)
+
+    def add(self, delivery_tag, routing_key, properties, body):
+        batches = []
+        unpacked = self.unpack(body)
+
+        if self.delivery_tags and (unpacked is None or routing_key != self.routing_key or
+                                   unpacked[0] != self.header or self.size + len(unpacked[1]) > self.max_bytes):
+            batches.append(self.flush())
+
+        # messages whose packets don't share a header are published as they are
+        if unpacked is None:
+            batches.append(([delivery_tag], routing_key, properties, body))
+            return batches
+
+        self.header, datagrams = unpacked
+        self.delivery_tags.append(delivery_tag)
+        self.datagrams.append(datagrams)
+        self.size += len(datagrams)
+        self.routing_key = routing_key
+        self.properties = properties
+
+        if self.size >= self.max_bytes or len(self.delivery_tags) >= self.max_messages:
+            batches.append(self.flush())
+
+        return batches
+
+    def flush(self):
+        datagrams = b''.join(self.datagrams)
+        if isinstance(self.header, bytes):
+            body = rewrite.pack_packet(self.header, datagrams)
+        else:
+            body = waggle.protocol.pack_waggle_packets([dict(self.header, body=datagrams)])
+        batch = (self.delivery_tags, self.routing_key, self.properties, body)
+        self.generation += 1
+        self.reset()
+        return batch
+
+    def unpack(self, body):
+        """Returns the shared packet header and joined datagrams of a message
+        or None if its packets don't all share one header. Headers are raw
+        bytes on the fast path and waggle.protocol dicts otherwise."""
+        packets = None
+        if self.fast_path:
+            try:
+                packets = list(rewrite.iter_packets(body))
+            except rewrite.MalformedMessage:
+                pass
+        if packets is None:
+            packets = [({k: v for k, v in packet.items() if k != 'body'}, packet['body'])
+                       for packet in waggle.protocol.unpack_waggle_packets(body)]
+
+        if not packets or any(header != packets[0][0] for header, _ in packets[1:]):
+            return None
+        return packets[0][0], b''.join(data for _, data in packets)
@@ -0,0 +1,152 @@
+import unittest
+
+try:
+    import waggle.protocol
+    from coalesce import Coalescer
+except ImportError:
+    waggle = None
+
+
+NODE_ID = '0123456789abcdef'
+SUB_ID = 'fedcba9876543210'
+
+
+def make_message(*bodies, timestamp=1600000000):
+    return waggle.protocol.pack_waggle_packets([
+        {
+            'sender_id': NODE_ID,
+            'sender_sub_id': SUB_ID,
+            'timestamp': timestamp,
+            'body': waggle.protocol.pack_datagrams([{'body': body}]),
+        }
+        for body in bodies
+    ])
+
+
+def unpack_bodies(body):
+    packets = waggle.protocol.unpack_waggle_packets(body)
+    return [datagram['body'] for packet in packets for datagram in waggle.protocol.unpack_datagrams(packet['body'])]
+
+
+def datagrams_size(body):
+    return sum(len(packet['body']) for packet in waggle.protocol.unpack_waggle_packets(body))
+
+
+@unittest.skipUnless(waggle, 'requires pywaggle')
+class TestCoalescer(unittest.TestCase):
+
+    def check_batches(self, fast_path):
+        size = datagrams_size(make_message(b'x' * 10))
+        coalescer = Coalescer(max_bytes=3 * size, max_messages=100, fast_path=fast_path)
+
+        batches = []
+        for i in range(7):
+            batches += coalescer.add(i, 'a.b', 'props', make_message(b'%09d' % i))
+
+        # flushes as soon as max_bytes is reached
+        self.assertEqual([tags for tags, _, _, _ in batches], [[0, 1, 2], [3, 4, 5]])
+        self.assertEqual(len(coalescer), 1)
+
+        batches.append(coalescer.flush())
+        self.assertEqual(len(coalescer), 0)
+
+        for tags, routing_key, properties, body in batches:
+            self.assertEqual(routing_key, 'a.b')
+            self.assertEqual(properties, 'props')
+            packets = waggle.protocol.unpack_waggle_packets(body)
+            self.assertEqual(len(packets), 1)
+            self.assertEqual(packets[0]['sender_id'], NODE_ID)
+            self.assertEqual(packets[0]['sender_sub_id'], SUB_ID)
+            self.assertEqual(unpack_bodies(body), [b'%09d' % i for i in tags])
+
+    def test_max_bytes(self):
+        self.check_batches(fast_path=True)
+
+    def test_max_bytes_slow_path(self):
+        self.check_batches(fast_path=False)
+
+    def test_max_bytes_overflow(self):
+        size = datagrams_size(make_message(b'x' * 10))
+        coalescer = Coalescer(max_bytes=2 * size + 1, max_messages=100)
+
+        self.assertEqual(coalescer.add(0, 'a.b', None, make_message(b'x' * 10)), [])
+        self.assertEqual(coalescer.add(1, 'a.b', None, make_message(b'x' * 10)), [])
+
+        # a message which would go over max_bytes is put in the next batch
+        batches = coalescer.add(2, 'a.b', None, make_message(b'x' * 10))
+        self.assertEqual([tags for tags, _, _, _ in batches], [[0, 1]])
+        self.assertEqual(len(coalescer), 1)
+
+    def test_max_messages(self):
+        coalescer = Coalescer(max_bytes=1 << 20, max_messages=2)
+
+        self.assertEqual(coalescer.add(0, 'a.b', None, make_message(b'0')), [])
+        batches = coalescer.add(1, 'a.b', None, make_message(b'1', b'2'))
+
+        self.assertEqual(len(batches), 1)
+        tags, _, _, body = batches[0]
+        self.assertEqual(tags, [0, 1])
+        self.assertEqual(unpack_bodies(body), [b'0', b'1', b'2'])
+        self.assertEqual(len(coalescer), 0)
+
+    def test_routing_key_change(self):
+        coalescer = Coalescer(max_bytes=1 << 20, max_messages=100)
+
+        self.assertEqual(coalescer.add(0, 'a.b', None, make_message(b'0')), [])
+        batches = coalescer.add(1, 'c.d', None, make_message(b'1'))
+
+        self.assertEqual([(tags, key) for tags, key, _, _ in batches], [([0], 'a.b')])
+        self.assertEqual(coalescer.flush()[:2], ([1], 'c.d'))
+
+    def check_headers(self, fast_path):
+        coalescer = Coalescer(max_bytes=1 << 20, max_messages=100, fast_path=fast_path)
+
+        batches = []
+        batches += coalescer.add(0, 'a.b', None, make_message(b'0', timestamp=1600000000))
+        batches += coalescer.add(1, 'a.b', None, make_message(b'1', timestamp=1600000000))
+        batches += coalescer.add(2, 'a.b', None, make_message(b'2', timestamp=1600000001))
+        batches.append(coalescer.flush())
+
+        self.assertEqual([tags for tags, _, _, _ in batches], [[0, 1], [2]])
+
+        timestamps = []
+        for _, _, _, body in batches:
+            packets = waggle.protocol.unpack_waggle_packets(body)
+            self.assertEqual(len(packets), 1)
+            timestamps.append(packets[0]['timestamp'])
+            self.assertEqual(packets[0]['sender_id'], NODE_ID)
+            self.assertEqual(packets[0]['sender_sub_id'], SUB_ID)
+        self.assertEqual(timestamps, [1600000000, 1600000001])
+        self.assertEqual([unpack_bodies(body) for _, _, _, body in batches], [[b'0', b'1'], [b'2']])
+
+    def test_headers(self):
+        self.check_headers(fast_path=True)
+
+    def test_headers_slow_path(self):
+        self.check_headers(fast_path=False)
+
+    def test_mixed_headers(self):
+        coalescer = Coalescer(max_bytes=1 << 20, max_messages=100)
+        mixed = waggle.protocol.pack_waggle_packets([
+            {'timestamp': 1600000000, 'body': waggle.protocol.pack_datagrams([{'body': b'1'}])},
+            {'timestamp': 1600000001, 'body': waggle.protocol.pack_datagrams([{'body': b'2'}])},
+        ])
+
+        self.assertEqual(coalescer.add(0, 'a.b', None, make_message(b'0')), [])
+        batches = coalescer.add(1, 'a.b', None, mixed)
+
+        # the pending batch is flushed and the mixed message is passed through
+        self.assertEqual([tags for tags, _, _, _ in batches], [[0], [1]])
+        self.assertEqual(batches[1][3], mixed)
+        self.assertEqual(len(coalescer), 0)
+
+    def test_generation(self):
+        coalescer = Coalescer(max_bytes=1 << 20, max_messages=100)
+        coalescer.add(0, 'a.b', None, make_message(b'0'))
+        generation = coalescer.generation
+        coalescer.flush()
+        self.assertNotEqual(coalescer.generation, generation)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# ANL:waggle-license
+#  This file is part of the Waggle Platform.  Please see the file
+#  LICENSE.waggle.txt for the legal details of the copyright and software
+#  license.  For more details on the Waggle project, visit:
+#           http://www.wa8.gl
+# ANL:waggle-license
+"""
+Generates testdata/rewrite.json, the messages rewrite_test.py checks the fast
+path against when pywaggle isn't installed.
+
+Each case holds a message packed by waggle.protocol and the output of the
+slow path for it, so the fixture must be generated with the pywaggle version
+in requirements.txt. The service image has it installed:
+
+    docker build -t stage-messages .
+    docker run --rm --entrypoint python3 -v "$PWD/testdata:/app/testdata" stage-messages make_rewrite_fixture.py
+"""
+import importlib.machinery
+import importlib.util
+import json
+import os
+import random
+from pathlib import Path
+
+os.environ.setdefault('WAGGLE_NODE_ID', '0000000000000001')
+
+import waggle.protocol
+
+
+def load_stage_messages():
+    # stage-messages-amqp isn't a valid module name, so we load it by path
+    loader = importlib.machinery.SourceFileLoader('stage_messages', str(Path(__file__).parent / 'stage-messages-amqp'))
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))
+    loader.exec_module(module)
+    return module
+
+
+def make_messages(rng):
+    yield waggle.protocol.pack_waggle_packets([
+        {
+            'sender_id': '1111111111111111',
+            'sender_sub_id': '2222222222222222',
+            'body': waggle.protocol.pack_datagrams([
+                {'plugin_id': 9, 'plugin_major_version': 8, 'plugin_patch_version': 4, 'body': b'abc'},
+                {'body': rng.randbytes(300)},
+                {'body': b''},
+            ]),
+        },
+        {
+            'body': waggle.protocol.pack_datagrams([
+                {'plugin_instance': 3, 'body': rng.randbytes(600)},
+            ]),
+        },
+        {
+            'sender_id': 'aaaaaaaaaaaaaaaa',
+            'body': waggle.protocol.pack_datagrams([
+                {'body': rng.randbytes(n)} for n in range(0, 40, 7)
+            ]),
+        },
+    ])
+
+    yield waggle.protocol.pack_waggle_packets([
+        {'body': waggle.protocol.pack_datagrams([{'body': rng.randbytes(20)}])},
+    ])
+
+
+def main():
+    stage_messages = load_stage_messages()
+    rng = random.Random(1)
+    cases = []
+
+    for user_id, node_id, sub_id in [
+        ('plugin-37-2.13.1-4', '0123456789abcdef', 'fedcba9876543210'),
+        ('plugin-65535-255.255.0-255', '0000000000000001', '0000000000000000'),
+    ]:
+        info = stage_messages.parse_plugin_user_id(user_id)
+        for body in make_messages(rng):
+            cases.append({
+                'node_id': node_id,
+                'sub_id': sub_id,
+                'plugin': {'id': info['id'], 'version': list(info['version']), 'instance': info['instance']},
+                'input': body.hex(),
+                'output': stage_messages.stage_message_slow(body, info, node_id, sub_id).hex(),
+            })
+
+    path = Path(__file__).parent / 'testdata' / 'rewrite.json'
+    path.parent.mkdir(exist_ok=True)
+    path.write_text(json.dumps({'pywaggle': getattr(waggle, '__version__', None), 'cases': cases}, indent=2) + '\n')
+    print(f'Wrote {len(cases)} cases to {path}.')
+
+
+if __name__ == '__main__':
+    main()
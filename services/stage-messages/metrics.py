@@ -0,0 +1,256 @@
+# ANL:waggle-license
+#  This file is part of the Waggle Platform.  Please see the file
+#  LICENSE.waggle.txt for the legal details of the copyright and software
+#  license.  For more details on the Waggle project, visit:
+#           http://www.wa8.gl
+# ANL:waggle-license
+"""
+Minimal in-process metrics with a Prometheus text format HTTP endpoint.
+
+Metrics are updated from the consumer thread and rendered from the HTTP
+server thread. Updates are simple int / float operations, so we rely on the
+GIL rather than taking a lock on every update.
+"""
+import bisect
+import http.server
+import threading
+import time
+
+
+DEFAULT_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+)
+
+registry = []
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('"', r'\"')) for k, v in pairs) + '}'
+
+
+class Metric:
+
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def labels(self, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        try:
+            return self.children[key]
+        except KeyError:
+            pass
+        with self.lock:
+            return self.children.setdefault(key, self.new_child())
+
+    def default(self):
+        return self.labels()
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} {self.type}',
+        ]
+        for key, child in list(self.children.items()):
+            lines += child.render(self.name, self.labelnames, key)
+        return lines
+
+
+class CounterValue:
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def take(self):
+        if self.value == 0:
+            return None
+        value, self.value = self.value, 0
+        return value
+
+    def apply(self, value):
+        self.value += value
+
+    def render(self, name, labelnames, key):
+        return [f'{name}{format_labels(labelnames, key)} {self.value}']
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def new_child(self):
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self.default().inc(amount)
+
+
+class GaugeValue:
+
+    def __init__(self):
+        self.value = 0
+        self.func = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, func):
+        self.func = func
+
+    def take(self):
+        # gauges describe the process which owns them, so they aren't moved
+        return None
+
+    def render(self, name, labelnames, key):
+        value = self.func() if self.func is not None else self.value
+        return [f'{name}{format_labels(labelnames, key)} {value}']
+
+
+class Gauge(Metric):
+
+    type = 'gauge'
+
+    def new_child(self):
+        return GaugeValue()
+
+    def set(self, value):
+        self.default().set(value)
+
+    def set_function(self, func):
+        self.default().set_function(func)
+
+
+class HistogramValue:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def time(self):
+        return Timer(self)
+
+    def take(self):
+        if not any(self.counts):
+            return None
+        update = (self.counts, self.sum)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        return update
+
+    def apply(self, update):
+        counts, total = update
+        for i, count in enumerate(counts):
+            self.counts[i] += count
+        self.sum += total
+
+    def render(self, name, labelnames, key):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append(f'{name}_bucket{format_labels(labelnames, key, [("le", bound)])} {total}')
+        total += self.counts[-1]
+        lines.append(f'{name}_bucket{format_labels(labelnames, key, [("le", "+Inf")])} {total}')
+        lines.append(f'{name}_sum{format_labels(labelnames, key)} {self.sum}')
+        lines.append(f'{name}_count{format_labels(labelnames, key)} {total}')
+        return lines
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labelnames)
+
+    def new_child(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.default().observe(value)
+
+    def time(self):
+        return self.default().time()
+
+
+class Timer:
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+def take_updates():
+    """Returns the counter and histogram updates made since the last call and
+    resets them. Worker processes forked from the process serving metrics
+    send these back to it, which adds them using apply_updates."""
+    updates = []
+    for index, metric in enumerate(registry):
+        for key, child in list(metric.children.items()):
+            update = child.take()
+            if update is not None:
+                updates.append((index, key, update))
+    return updates
+
+
+def apply_updates(updates):
+    for index, key, update in updates:
+        metric = registry[index]
+        metric.labels(**dict(zip(metric.labelnames, key))).apply(update)
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host='0.0.0.0'):
+    """Starts serving metrics on a background thread."""
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,43 @@
+import unittest
+
+import metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.registry[:]
+
+    def tearDown(self):
+        metrics.registry[:] = self.registry
+
+    def test_updates(self):
+        counter = metrics.Counter('test_counter_total', 'Test counter.', ['user_id'])
+        histogram = metrics.Histogram('test_seconds', 'Test histogram.', buckets=(1, 2))
+        gauge = metrics.Gauge('test_gauge', 'Test gauge.')
+
+        counter.labels(user_id='a').inc()
+        counter.labels(user_id='b').inc(2)
+        histogram.observe(0.5)
+        histogram.observe(3)
+        gauge.set(5)
+
+        updates = metrics.take_updates()
+
+        # taking resets the values, so nothing is sent twice
+        self.assertEqual(counter.labels(user_id='a').value, 0)
+        self.assertEqual(histogram.default().counts, [0, 0, 0])
+        self.assertEqual([u for u in metrics.take_updates() if metrics.registry[u[0]] in (counter, histogram)], [])
+
+        metrics.apply_updates(updates)
+        metrics.apply_updates(updates)
+
+        self.assertEqual(counter.labels(user_id='a').value, 2)
+        self.assertEqual(counter.labels(user_id='b').value, 4)
+        self.assertEqual(histogram.default().counts, [2, 0, 2])
+        self.assertEqual(histogram.default().sum, 7)
+        self.assertEqual(gauge.default().value, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
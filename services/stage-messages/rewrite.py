@@ -0,0 +1,203 @@
+# ANL:waggle-license
+#  This file is part of the Waggle Platform.  Please see the file
+#  LICENSE.waggle.txt for the legal details of the copyright and software
+#  license.  For more details on the Waggle project, visit:
+#           http://www.wa8.gl
+# ANL:waggle-license
+"""
+Fast path for stamping node and plugin metadata into waggle messages.
+
+Instead of fully unpacking and repacking every packet and datagram, the
+header fields are patched directly in a copy of the original body. Any
+message which doesn't match the expected layout raises MalformedMessage so
+the caller can fall back to waggle.protocol.
+"""
+import struct
+import zlib
+
+
+class MalformedMessage(Exception):
+    pass
+
+
+def layout(fields):
+    offsets = {}
+    offset = 0
+    for name, size in fields:
+        offsets[name] = (offset, size)
+        offset += size
+    return offsets, offset
+
+
+# waggle packet layout. the crc32 trailer covers the header and body.
+PACKET_FIELDS, PACKET_HEADER_SIZE = layout([
+    ('protocol_version', 1),
+    ('timestamp', 4),
+    ('flags', 1),
+    ('sender_id', 8),
+    ('sender_sub_id', 8),
+    ('receiver_id', 8),
+    ('receiver_sub_id', 8),
+    ('sender_seq', 3),
+    ('sender_sid', 2),
+    ('token', 2),
+    ('body_length', 4),
+])
+
+PACKET_CRC_SIZE = 4
+
+# datagram layout. the crc8 trailer only covers the body, so patching the
+# plugin fields doesn't require recomputing it. we don't check it either, so
+# unlike waggle.protocol, a datagram with a corrupt body is passed through
+# with its original crc8 rather than rejected. it's still rejected by the
+# decoder wherever the datagram is eventually unpacked.
+DATAGRAM_START = 0xaa
+DATAGRAM_END = 0x55
+
+DATAGRAM_FIELDS, DATAGRAM_HEADER_SIZE = layout([
+    ('start', 1),
+    ('body_length', 3),
+    ('protocol_version', 1),
+    ('timestamp', 4),
+    ('packet_seq', 2),
+    ('packet_type', 1),
+    ('plugin_id', 2),
+    ('plugin_major_version', 1),
+    ('plugin_minor_version', 1),
+    ('plugin_patch_version', 1),
+    ('plugin_instance', 1),
+    ('plugin_run_id', 2),
+])
+
+DATAGRAM_TRAILER_SIZE = 2
+
+# plugin_id through plugin_minor_version are contiguous and are followed by
+# the plugin_patch_version, which isn't part of the plugin user ID, and then
+# plugin_instance.
+PLUGIN_VERSION_OFFSET = DATAGRAM_FIELDS['plugin_id'][0]
+PLUGIN_VERSION_STRUCT = struct.Struct('>HBB')
+PLUGIN_INSTANCE_OFFSET = DATAGRAM_FIELDS['plugin_instance'][0]
+
+# sender_id and sender_sub_id are also contiguous.
+SENDER_OFFSET = PACKET_FIELDS['sender_id'][0]
+SENDER_SIZE = 16
+
+
+def read_uint(buf, offset, size):
+    return int.from_bytes(buf[offset:offset+size], 'big')
+
+
+def pack_sender(sender_id, sender_sub_id):
+    try:
+        data = bytes.fromhex(sender_id) + bytes.fromhex(sender_sub_id)
+    except ValueError:
+        raise ValueError('Sender IDs must be hex strings.')
+    if len(data) != SENDER_SIZE:
+        raise ValueError('Sender IDs must be 16 hex digits.')
+    return data
+
+
+def pack_plugin(plugin_info):
+    try:
+        version = PLUGIN_VERSION_STRUCT.pack(
+            plugin_info['id'],
+            plugin_info['version'][0],
+            plugin_info['version'][1])
+        instance = struct.pack('>B', plugin_info['instance'])
+    except struct.error:
+        raise ValueError('Plugin info out of range.')
+    return version, instance
+
+
+def rewrite_datagrams(buf, start, end, plugin):
+    version, instance = plugin
+    offset = start
+
+    while offset < end:
+        if end - offset < DATAGRAM_HEADER_SIZE + DATAGRAM_TRAILER_SIZE:
+            raise MalformedMessage('Truncated datagram header.')
+        if buf[offset] != DATAGRAM_START:
+            raise MalformedMessage('Invalid datagram start byte.')
+
+        body_length = read_uint(buf, offset+1, 3)
+        datagram_end = offset + DATAGRAM_HEADER_SIZE + body_length + DATAGRAM_TRAILER_SIZE
+
+        if datagram_end > end:
+            raise MalformedMessage('Truncated datagram body.')
+        if buf[datagram_end-1] != DATAGRAM_END:
+            raise MalformedMessage('Invalid datagram end byte.')
+
+        buf[offset+PLUGIN_VERSION_OFFSET:offset+PLUGIN_VERSION_OFFSET+PLUGIN_VERSION_STRUCT.size] = version
+        buf[offset+PLUGIN_INSTANCE_OFFSET:offset+PLUGIN_INSTANCE_OFFSET+1] = instance
+        offset = datagram_end
+
+
+def rewrite_message(body, sender, plugin):
+    """Returns a copy of body with the sender IDs and plugin info of every
+    packet and datagram replaced. sender and plugin must be built using
+    pack_sender and pack_plugin.
+    """
+    buf = bytearray(body)
+    view = memoryview(buf)
+    offset = 0
+
+    if len(buf) == 0:
+        raise MalformedMessage('Empty message.')
+
+    while offset < len(buf):
+        if len(buf) - offset < PACKET_HEADER_SIZE + PACKET_CRC_SIZE:
+            raise MalformedMessage('Truncated packet header.')
+
+        body_start = offset + PACKET_HEADER_SIZE
+        body_end = body_start + read_uint(buf, offset+PACKET_FIELDS['body_length'][0], 4)
+        packet_end = body_end + PACKET_CRC_SIZE
+
+        if packet_end > len(buf):
+            raise MalformedMessage('Truncated packet body.')
+        if zlib.crc32(view[offset:body_end]) != read_uint(buf, body_end, PACKET_CRC_SIZE):
+            raise MalformedMessage('Packet CRC mismatch.')
+
+        buf[offset+SENDER_OFFSET:offset+SENDER_OFFSET+SENDER_SIZE] = sender
+        rewrite_datagrams(buf, body_start, body_end, plugin)
+
+        crc = zlib.crc32(view[offset:body_end])
+        buf[body_end:packet_end] = crc.to_bytes(PACKET_CRC_SIZE, 'big')
+        offset = packet_end
+
+    view.release()
+    return bytes(buf)
+
+
+def iter_packets(body):
+    """Yields the (header, body) of each packet in body. The header has its
+    body length zeroed, so the headers of packets which only differ in their
+    bodies compare equal."""
+    view = memoryview(body)
+    offset = 0
+    length_offset, length_size = PACKET_FIELDS['body_length']
+
+    while offset < len(view):
+        if len(view) - offset < PACKET_HEADER_SIZE + PACKET_CRC_SIZE:
+            raise MalformedMessage('Truncated packet header.')
+
+        body_start = offset + PACKET_HEADER_SIZE
+        body_end = body_start + read_uint(view, offset+length_offset, length_size)
+        packet_end = body_end + PACKET_CRC_SIZE
+
+        if packet_end > len(view):
+            raise MalformedMessage('Truncated packet body.')
+
+        header = bytearray(view[offset:body_start])
+        header[length_offset:length_offset+length_size] = bytes(length_size)
+        yield bytes(header), view[body_start:body_end]
+        offset = packet_end
+
+
+def pack_packet(header, body):
+    """Returns a packet with the header from iter_packets and body."""
+    length_offset, length_size = PACKET_FIELDS['body_length']
+    buf = bytearray(header)
+    buf[length_offset:length_offset+length_size] = len(body).to_bytes(length_size, 'big')
+    buf += body
+    buf += zlib.crc32(buf).to_bytes(PACKET_CRC_SIZE, 'big')
+    return bytes(buf)
@@ -0,0 +1,165 @@
+import importlib.machinery
+import importlib.util
+import json
+import os
+import random
+import unittest
+import zlib
+from pathlib import Path
+
+import rewrite
+
+os.environ.setdefault('WAGGLE_NODE_ID', '0000000000000001')
+
+FIXTURE_PATH = Path(__file__).parent / 'testdata' / 'rewrite.json'
+
+
+def load_stage_messages():
+    # stage-messages-amqp isn't a valid module name, so we load it by path
+    loader = importlib.machinery.SourceFileLoader('stage_messages', str(Path(__file__).parent / 'stage-messages-amqp'))
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))
+    loader.exec_module(module)
+    return module
+
+
+try:
+    stage_messages = load_stage_messages()
+    import waggle.protocol
+except ImportError:
+    stage_messages = None
+
+
+def make_datagram(body, crc=0):
+    header = bytearray(rewrite.DATAGRAM_HEADER_SIZE)
+    header[0] = rewrite.DATAGRAM_START
+    header[1:4] = len(body).to_bytes(3, 'big')
+    return bytes(header) + body + bytes([crc, rewrite.DATAGRAM_END])
+
+
+NODE_ID = '0123456789abcdef'
+SUB_ID = 'fedcba9876543210'
+
+
+def make_message(rng):
+    return waggle.protocol.pack_waggle_packets([
+        {
+            'sender_id': '1111111111111111',
+            'sender_sub_id': '2222222222222222',
+            'body': waggle.protocol.pack_datagrams([
+                {'plugin_id': 9, 'plugin_major_version': 8, 'plugin_patch_version': 4, 'body': b'abc'},
+                {'body': rng.randbytes(300)},
+                {'body': b''},
+            ]),
+        },
+        {
+            'body': waggle.protocol.pack_datagrams([
+                {'plugin_instance': 3, 'body': rng.randbytes(70000)},
+            ]),
+        },
+        {
+            'sender_id': 'aaaaaaaaaaaaaaaa',
+            'body': waggle.protocol.pack_datagrams([
+                {'body': rng.randbytes(n)} for n in range(0, 40, 7)
+            ]),
+        },
+    ])
+
+
+@unittest.skipUnless(FIXTURE_PATH.exists(), 'requires testdata/rewrite.json. see make_rewrite_fixture.py')
+class TestRewriteFixture(unittest.TestCase):
+    """Checks the fast path against messages and slow path output recorded
+    with the pinned pywaggle, so the layout is checked without it."""
+
+    def test_matches_slow_path(self):
+        cases = json.loads(FIXTURE_PATH.read_text())['cases']
+        self.assertTrue(cases)
+
+        for case in cases:
+            info = dict(case['plugin'], version=tuple(case['plugin']['version']))
+            sender = rewrite.pack_sender(case['node_id'], case['sub_id'])
+            output = rewrite.rewrite_message(bytes.fromhex(case['input']), sender, rewrite.pack_plugin(info))
+            self.assertEqual(output.hex(), case['output'])
+
+
+class TestDatagramCRC(unittest.TestCase):
+
+    def test_corrupt_datagram_passes_through(self):
+        # the fast path doesn't check datagram crc8s, so a bad one is kept
+        header = bytes(rewrite.PACKET_HEADER_SIZE)
+        body = make_datagram(b'hello', crc=0x12) + make_datagram(b'', crc=0x34)
+        message = rewrite.pack_packet(header, body)
+
+        sender = rewrite.pack_sender('0123456789abcdef', 'fedcba9876543210')
+        plugin = rewrite.pack_plugin({'id': 37, 'version': (2, 13, 1), 'instance': 4})
+        output = rewrite.rewrite_message(message, sender, plugin)
+
+        (_, datagrams), = rewrite.iter_packets(output)
+        datagrams = bytes(datagrams)
+        first_end = rewrite.DATAGRAM_HEADER_SIZE + 5 + rewrite.DATAGRAM_TRAILER_SIZE
+        self.assertEqual(datagrams[first_end-2], 0x12)
+        self.assertEqual(datagrams[-2], 0x34)
+        self.assertEqual(datagrams[rewrite.PLUGIN_INSTANCE_OFFSET], 4)
+        self.assertEqual(datagrams[first_end+rewrite.PLUGIN_INSTANCE_OFFSET], 4)
+
+
+@unittest.skipUnless(stage_messages, 'requires pika and pywaggle')
+class TestRewrite(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin = stage_messages.lookup_plugin('plugin-37-2.13.1-4')
+        self.sender = rewrite.pack_sender(NODE_ID, SUB_ID)
+
+    def test_matches_slow_path(self):
+        rng = random.Random(1)
+        body = make_message(rng)
+
+        fast = rewrite.rewrite_message(body, self.sender, self.plugin.packed)
+        slow = stage_messages.stage_message_slow(body, self.plugin.info, NODE_ID, SUB_ID)
+        self.assertEqual(fast, slow)
+
+        packets = waggle.protocol.unpack_waggle_packets(fast)
+        self.assertEqual(len(packets), 3)
+
+        for packet in packets:
+            self.assertEqual(packet['sender_id'], NODE_ID)
+            self.assertEqual(packet['sender_sub_id'], SUB_ID)
+            for datagram in waggle.protocol.unpack_datagrams(packet['body']):
+                self.assertEqual(datagram['plugin_id'], 37)
+                self.assertEqual(datagram['plugin_major_version'], 2)
+                self.assertEqual(datagram['plugin_minor_version'], 13)
+                self.assertEqual(datagram['plugin_instance'], 4)
+
+    def test_crc(self):
+        body = make_message(random.Random(2))
+        fast = rewrite.rewrite_message(body, self.sender, self.plugin.packed)
+
+        # each packet's crc32 trailer covers its header and body
+        offset = 0
+        while offset < len(fast):
+            start, size = rewrite.PACKET_FIELDS['body_length']
+            body_length = rewrite.read_uint(fast, offset + start, size)
+            end = offset + rewrite.PACKET_HEADER_SIZE + body_length
+            self.assertEqual(zlib.crc32(fast[offset:end]), rewrite.read_uint(fast, end, rewrite.PACKET_CRC_SIZE))
+            offset = end + rewrite.PACKET_CRC_SIZE
+        self.assertEqual(offset, len(fast))
+
+    def test_stager(self):
+        body = make_message(random.Random(3))
+        stager = stage_messages.MessageStager(NODE_ID, SUB_ID)
+        self.assertIsNotNone(stager.sender)
+        self.assertEqual(stager.stage(body, self.plugin),
+                         stage_messages.stage_message_slow(body, self.plugin.info, NODE_ID, SUB_ID))
+
+    def test_malformed(self):
+        body = make_message(random.Random(4))
+
+        corrupt = bytearray(body)
+        corrupt[rewrite.PACKET_HEADER_SIZE + 30] ^= 1
+
+        for bad in [body[:-1], body + b'\x00', body[:10], bytes(corrupt)]:
+            with self.assertRaises(rewrite.MalformedMessage):
+                rewrite.rewrite_message(bad, self.sender, self.plugin.packed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Measures virtual-waggle CLI startup time and which modules are imported.
+
+Each command line is run several times in a fresh interpreter with
+-X importtime. Reports the median wall time and the slowest imports, and exits
+with an error if any median exceeds --max-ms.
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+
+ROOT = Path(__file__).absolute().parent.parent
+
+DEFAULT_COMMANDS = [
+    ['--help'],
+    ['up', '--help'],
+    ['run', '--help'],
+    ['build', '--help'],
+]
+
+
+def run_once(argv):
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', 'waggle_node.py', *argv],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    duration = time.perf_counter() - start
+    return duration, parse_importtime(proc.stderr.decode())
+
+
+# importlib.import_module doesn't show up in -X importtime output, so the
+# imported command modules are listed separately.
+LIST_COMMAND_MODULES = """
+import atexit, runpy, sys
+atexit.register(lambda: print(' '.join(sorted(m for m in sys.modules if m.startswith('commands.'))), file=sys.stderr))
+sys.argv = ['waggle_node.py'] + sys.argv[1:]
+runpy.run_path('waggle_node.py', run_name='__main__')
+"""
+
+
+def get_command_modules(argv):
+    proc = subprocess.run([sys.executable, '-c', LIST_COMMAND_MODULES, *argv],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    lines = proc.stderr.decode().splitlines()
+    return lines[-1].split() if lines else []
+
+
+def parse_importtime(output):
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            imports.append((int(fields[1]), fields[2].strip()))
+        except (IndexError, ValueError):
+            continue
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=10, help='runs per command')
+    parser.add_argument('--top', type=int, default=5, help='number of slowest imports to show')
+    parser.add_argument('--max-ms', type=float, help='fail if any median startup time exceeds this')
+    args = parser.parse_args()
+
+    failed = False
+
+    for argv in DEFAULT_COMMANDS:
+        results = [run_once(argv) for _ in range(args.n)]
+        median_ms = statistics.median(duration for duration, _ in results) * 1000
+        imports = results[-1][1]
+        commands = get_command_modules(argv)
+
+        print(f'virtual-waggle {" ".join(argv)}: {median_ms:.1f}ms median, {len(imports)} modules imported')
+        print(f'  command modules: {", ".join(commands) or "none"}')
+        for cumulative, name in sorted(imports, reverse=True)[:args.top]:
+            print(f'  {cumulative / 1000:7.1f}ms {name}')
+
+        if args.max_ms is not None and median_ms > args.max_ms:
+            failed = True
+
+    if failed:
+        print(f'startup time exceeded {args.max_ms}ms', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,72 @@
 import argparse
+import importlib
 import os
 import subprocess
 import sys
-import commands.up
-import commands.down
-import commands.report
-import commands.logs
-import commands.build
-import commands.run
-import commands.newplugin
 
 
-def main():
+# Commands are listed here instead of being imported, so building the command
+# list for --help doesn't import any command modules. A command's module is
+# only imported when it's run. Each module must register a parser with the
+# same name.
+COMMANDS = [
+    ('up', 'commands.up', 'start virtual waggle environment'),
+    ('down', 'commands.down', 'stop virtual waggle environment'),
+    ('logs', 'commands.logs', 'show virtual waggle system logs'),
+    ('report', 'commands.report', 'show virtual waggle system report for debugging'),
+    ('status', 'commands.status', 'show shovel and queue throughput'),
+    ('loadtest', 'commands.loadtest', 'measure end-to-end message throughput and latency'),
+    ('capture', 'commands.capture', 'record messages from plugins for replay'),
+    ('replay', 'commands.replay', 'replay recorded plugin messages'),
+    ('build', 'commands.build', 'build plugin for virtual waggle from a directory'),
+    ('run', 'commands.run', 'runs a plugin inside virtual waggle environment'),
+    ('newplugin', 'commands.newplugin', 'generates a new plugin'),
+]
+
+
+def add_global_arguments(parser):
+    parser.add_argument('-p', '--project-name', default=os.path.basename(os.getcwd()), help='specify project name (default: directory name)')
+
+
+def get_command_name(argv):
+    """Returns the name of the command in argv, or None if no command was
+    given, along with the top level parser. No command modules are imported."""
+    parser = argparse.ArgumentParser()
+    add_global_arguments(parser)
+    parser.set_defaults(command=None)
+
+    subparsers = parser.add_subparsers()
+    for name, _, help in COMMANDS:
+        subparser = subparsers.add_parser(name, help=help, add_help=False)
+        subparser.set_defaults(command=name)
+
+    args, _ = parser.parse_known_args(argv)
+    return args.command, parser
+
+
+def get_command_parser(name):
+    module_name = next(module for command, module, _ in COMMANDS if command == name)
+    module = importlib.import_module(module_name)
+
     parser = argparse.ArgumentParser()
     parser.set_defaults(func=lambda args: parser.print_help())
-    parser.add_argument('-p', '--project-name', default=os.path.basename(os.getcwd()), help='specify project name (default: directory name)')
+    add_global_arguments(parser)
 
     subparsers = parser.add_subparsers()
-    commands.up.register(subparsers)
-    commands.down.register(subparsers)
-    commands.logs.register(subparsers)
-    commands.report.register(subparsers)
-    commands.build.register(subparsers)
-    commands.run.register(subparsers)
-    commands.newplugin.register(subparsers)
-    args = parser.parse_args()
+    module.register(subparsers)
+    return parser
+
+
+def main():
+    argv = sys.argv[1:]
+    name, parser = get_command_name(argv)
+
+    if name is None:
+        parser.parse_args(argv)
+        parser.print_help()
+        return
+
+    args = get_command_parser(name).parse_args(argv)
 
     try:
         args.func(args)
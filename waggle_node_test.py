@@ -1,7 +1,18 @@
 import argparse
 import unittest
 import json
+import tempfile
+import http.server
+import threading
+from pathlib import Path
+import importlib
+from unittest import mock
 import commands.build
+import commands.run
+import logstore
+import placement
+import rabbitmq
+import waggle_node
 
 
 class TestUtils(unittest.TestCase):
@@ -35,6 +46,229 @@ class TestUtils(unittest.TestCase):
 
         self.assertEqual(name, 'plugin-test:1.2.3')
 
+    def test_build_key(self):
+        config = {
+            'id': 123,
+            'name': 'test',
+            'version': '1.2.3',
+        }
+
+        source = {
+            'architectures': ['linux/amd64'],
+        }
+
+        with tempfile.TemporaryDirectory() as dir:
+            plugin_dir = Path(dir)
+            (plugin_dir / 'plugin.py').write_text('print("hello")')
+
+            key = commands.build.get_build_key(plugin_dir, config, source, [], 'linux/amd64')
+            self.assertEqual(key, commands.build.get_build_key(plugin_dir, config, source, [], 'linux/amd64'))
+
+            self.assertNotEqual(key, commands.build.get_build_key(plugin_dir, config, source, ['--build-arg', 'A=1'], 'linux/amd64'))
+            self.assertNotEqual(key, commands.build.get_build_key(plugin_dir, config, source, [], 'linux/arm64'))
+
+            (plugin_dir / 'plugin.py').write_text('print("world")')
+            self.assertNotEqual(key, commands.build.get_build_key(plugin_dir, config, source, [], 'linux/amd64'))
+
+    def test_base_image(self):
+        with tempfile.TemporaryDirectory() as dir:
+            plugin_dir = Path(dir)
+            self.assertIsNone(commands.build.get_base_image(plugin_dir))
+
+            (plugin_dir / 'Dockerfile').write_text('# comment\nFROM --platform=linux/amd64 python:3 AS base\nRUN true\n')
+            self.assertEqual(commands.build.get_base_image(plugin_dir), 'python:3')
+
+            (plugin_dir / 'Dockerfile').write_text('FROM --platform=linux/amd64\n')
+            self.assertIsNone(commands.build.get_base_image(plugin_dir))
+
+    def test_batch_build_error(self):
+        with tempfile.TemporaryDirectory() as dir:
+            args = argparse.Namespace(build_arg=[], force=False)
+            plugin_dir, image_name, status, _, output = commands.build.build_plugin_logged(args, Path(dir))
+            self.assertIsNone(image_name)
+            self.assertEqual(status, 'failed')
+            self.assertIn('missing sage.json', output)
+
+
+class TestPlacement(unittest.TestCase):
+
+    def test_resource_request(self):
+        self.assertEqual(placement.get_resource_request({}), {'cpu': None, 'memory': None})
+        self.assertEqual(placement.get_resource_request({'resources': {'cpu': 1.5, 'memory': '512M'}}),
+                         {'cpu': 1.5, 'memory': 512 * 1024 * 1024})
+
+        with self.assertRaises(ValueError):
+            placement.get_resource_request({'resources': {'cpu': 0}})
+
+        with self.assertRaises(ValueError):
+            placement.get_resource_request({'resources': {'memory': 'lots'}})
+
+    def test_pack(self):
+        # whole cores go to empty cores and the fraction to the fullest core with room
+        self.assertEqual(placement.pack({1: 1.0, 2: 0.5, 3: 0.25}, 1.25), {1: 1.0, 3: 0.25})
+        self.assertEqual(placement.pack({1: 1.0, 2: 0.5}, 0.5), {2: 0.5})
+        self.assertIsNone(placement.pack({1: 0.5, 2: 0.5}, 1))
+
+    def test_place_and_release(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = Path(dir, 'test.json')
+            placements = placement.Placements(path, cpus=4, memory=4 * 1024 ** 3, reserved_cpus=1, reserved_memory=1024 ** 3)
+            request = {'cpu': 0.5, 'memory': 1024 ** 3}
+
+            allocations = placements.place(['a', 'b'], request)
+            self.assertEqual([a['cores'] for a in allocations], [{'1': 0.5}, {'1': 0.5}])
+            self.assertEqual(placements.get_docker_args(allocations[0]),
+                             ['--cpuset-cpus', '1', '--cpus', '0.5', '--memory', str(1024 ** 3)])
+
+            # only 1G of memory is left, so nothing from a failed placement is kept
+            with self.assertRaises(placement.PlacementError):
+                placements.place(['c', 'd'], request)
+            self.assertEqual(set(json.loads(path.read_text())), {'a', 'b'})
+
+            placements.release(['a'])
+            allocations = placements.place(['c'], {'cpu': 2, 'memory': None})
+            self.assertEqual(allocations[0]['cores'], {'2': 1.0, '3': 1.0})
+
+            # unlimited plugins can use any plugin core
+            allocations = placements.place(['e'], {'cpu': None, 'memory': None})
+            self.assertEqual(placements.get_docker_args(allocations[0]), ['--cpuset-cpus', '1,2,3'])
+
+
+class TestLogStore(unittest.TestCase):
+
+    def test_query(self):
+        with tempfile.TemporaryDirectory() as dir:
+            store = logstore.LogStore(dir)
+
+            # close a segment after every line and sync flush every write, so
+            # each source has several indexed segments and one open one.
+            with mock.patch.object(logstore, 'SEGMENT_MAX_BYTES', 1), mock.patch.object(logstore, 'FLUSH_INTERVAL', 0):
+                writers = {'rabbitmq': store.writer('rabbitmq'), 'plugin/1': store.writer('plugin/1')}
+                for i in range(1, 21):
+                    source = 'rabbitmq' if i % 2 else 'plugin/1'
+                    writers[source].write(float(i), f'{source} line {i}')
+
+            self.assertEqual(store.sources(), ['plugin_1', 'rabbitmq'])
+            self.assertEqual(len(list(store.read_index())), 18)
+            self.assertEqual(len(list(store.unindexed_segments())), 2)
+
+            results = list(store.query())
+            self.assertEqual([t for t, _, _ in results], [float(i) for i in range(1, 21)])
+            self.assertEqual(results[0], (1.0, 'rabbitmq', 'rabbitmq line 1'))
+            self.assertEqual(results[1], (2.0, 'plugin_1', 'plugin/1 line 2'))
+
+            results = list(store.query(sources=['plugin/1'], since=5, until=12))
+            self.assertEqual([t for t, _, _ in results], [6.0, 8.0, 10.0, 12.0])
+            self.assertTrue(all(source == 'plugin_1' for _, source, _ in results))
+
+            results = list(store.query(pattern=r'line 1\d$'))
+            self.assertEqual([t for t, _, _ in results], [float(i) for i in range(10, 20)])
+
+            # only segments overlapping the time range are opened
+            segments = store.find_segments(['rabbitmq'], since=5, until=9)
+            self.assertEqual(len(segments['rabbitmq']), 3)
+
+            self.assertEqual(store.last_timestamp('rabbitmq'), 19.0)
+            self.assertEqual(store.last_timestamp('plugin/1'), 20.0)
+
+            for writer in writers.values():
+                writer.close()
+
+            self.assertEqual(len(list(store.unindexed_segments())), 0)
+            self.assertEqual([t for t, _, _ in store.query()], [float(i) for i in range(1, 21)])
+
+
+class TestManagementClient(unittest.TestCase):
+
+    def setUp(self):
+        requests = self.requests = []
+        connections = self.connections = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                connections.append(self.client_address)
+
+            def do_PUT(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                requests.append(self.path)
+                self.send_response(204)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        # bind an ephemeral port, so we check the client doesn't assume 15672
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_shared_setup(self):
+        client = rabbitmq.ManagementClient(*self.server.server_address)
+        args = argparse.Namespace(project_name='test')
+        usernames = [f'plugin-1-1.0.0-{i}' for i in range(16)]
+
+        with mock.patch.object(commands.run, 'setup_rabbitmq_user_rabbitmqctl') as rabbitmqctl, client:
+            threads = [threading.Thread(target=commands.run.setup_rabbitmq_user, args=(args, client, username, 'secret'))
+                       for username in usernames]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        rabbitmqctl.assert_not_called()
+        self.assertEqual(sorted(self.requests), sorted([f'/api/users/{u}' for u in usernames] +
+                                                       [f'/api/permissions/%2F/{u}' for u in usernames]))
+        self.assertEqual(len(self.connections), 1)
+
+
+class TestRun(unittest.TestCase):
+
+    def test_placement_before_setup(self):
+        args = argparse.Namespace(project_name='test', plugin='plugin-test:1.0.0', instances=2, no_placement=False,
+                                  reserved_cpus=1, reserved_memory='512M', plugin_args=[])
+        labels = {'waggle.plugin.config': json.dumps({'id': 1, 'name': 'test', 'version': '1.0.0', 'resources': {'cpu': 64}})}
+        placements = mock.Mock()
+        placements.place.side_effect = placement.PlacementError('Not enough cpu.')
+
+        with mock.patch.object(commands.run, 'get_docker_image_labels', return_value=labels), \
+             mock.patch.object(placement.Placements, 'for_project', return_value=placements), \
+             mock.patch.object(commands.run, 'find_management_client') as find_management_client, \
+             mock.patch.object(commands.run, 'setup_instance') as setup_instance, \
+             mock.patch('subprocess.run') as run, \
+             mock.patch('sys.stdout'), mock.patch('sys.stderr'):
+            with self.assertRaises(SystemExit):
+                commands.run.run(args)
+
+        # nothing was set up or removed
+        find_management_client.assert_not_called()
+        setup_instance.assert_not_called()
+        run.assert_not_called()
+
+
+class TestCommands(unittest.TestCase):
+
+    def test_commands_registered(self):
+        for name, module_name, help in waggle_node.COMMANDS:
+            parser = argparse.ArgumentParser()
+            subparsers = parser.add_subparsers()
+            importlib.import_module(module_name).register(subparsers)
+            self.assertEqual(list(subparsers.choices), [name])
+            self.assertEqual(subparsers._choices_actions[0].help, help)
+
+    def test_get_command_name(self):
+        name, _ = waggle_node.get_command_name(['-p', 'test', 'run', '-n', '2', 'plugin'])
+        self.assertEqual(name, 'run')
+
+        name, _ = waggle_node.get_command_name([])
+        self.assertIsNone(name)
+
 
 if __name__ == '__main__':
     unittest.main()